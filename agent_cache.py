@@ -0,0 +1,398 @@
+import asyncio
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import aiohttp
+import numpy as np
+
+import llm_scheduler
+
+
+# -------------------------
+# AGENT ANSWER CACHE
+# -------------------------
+# Answers are kept in SQLite (one long-lived connection in WAL mode) with a
+# small in-memory LRU in front. Every entry expires after the TTL of its
+# query mode, so news goes stale quickly while explanations last. The table
+# is capped by rows and bytes; the least recently used answers are evicted
+# first. The blocking parts run off the event loop via the async wrappers.
+#
+# Queries are keyed by a normalized form (case, whitespace, punctuation and
+# common contractions folded), so "What is RL?" and "what's rl" share an
+# entry. When that misses, the query is embedded with Ollama and compared
+# against the embeddings of cached queries of the same mode; a close enough
+# match is served as a hit.
+
+CACHE_DB = os.getenv("AGENT_CACHE_DB", "agent_cache.db")
+
+# Seconds an answer stays valid, per classify_query mode
+TTLS = {
+    "news": int(os.getenv("AGENT_CACHE_TTL_NEWS", str(30 * 60))),
+    "theory": int(os.getenv("AGENT_CACHE_TTL_THEORY", str(7 * 24 * 3600))),
+}
+DEFAULT_TTL = min(TTLS.values())
+
+MAX_ROWS = int(os.getenv("AGENT_CACHE_MAX_ROWS", "5000"))
+MAX_BYTES = int(os.getenv("AGENT_CACHE_MAX_MB", "20")) * 1024 * 1024
+L1_MAX_ENTRIES = 256
+
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://192.168.0.242:11434")
+SEMANTIC_CACHE = os.getenv("AGENT_SEMANTIC_CACHE", "true").lower() not in ("false", "0", "off", "no")
+EMBED_MODEL = os.getenv("AGENT_EMBED_MODEL", "nomic-embed-text")
+# Cosine similarity a cached query needs to count as the same question
+SIMILARITY_THRESHOLD = float(os.getenv("AGENT_CACHE_SIMILARITY", "0.92"))
+# Longer inputs are conversations rather than questions; don't embed them
+SEMANTIC_MAX_CHARS = 500
+EMBED_TIMEOUT = aiohttp.ClientTimeout(total=10)
+# After a failed embedding call, skip the semantic layer for this long
+EMBED_RETRY_AFTER = 300
+
+CONTRACTIONS = {
+    "what's": "what is", "who's": "who is", "where's": "where is", "when's": "when is",
+    "how's": "how is", "it's": "it is", "that's": "that is", "there's": "there is",
+    "whats": "what is", "whos": "who is", "hows": "how is",
+    "can't": "cannot", "won't": "will not", "n't": " not", "'re": " are", "'ll": " will",
+}
+# Endings folded after any word ("don't" -> "do not"); everything else only
+# matches as a whole word, so "shows" or "whatsapp" are left alone
+CONTRACTION_SUFFIXES = ("n't", "'re", "'ll")
+_CONTRACTION_RE = re.compile(
+    r"(?<!\w)(?:"
+    + "|".join(re.escape(c) for c in sorted(CONTRACTIONS, key=len, reverse=True) if c not in CONTRACTION_SUFFIXES)
+    + r")(?!\w)|(?<=\w)(?:" + "|".join(re.escape(c) for c in CONTRACTION_SUFFIXES) + r")(?!\w)"
+)
+_PUNCTUATION_RE = re.compile(r"[^\w\s]")
+
+_db = None
+_db_lock = threading.Lock()
+# query -> (answer, expires_at), most recently used last
+_l1 = OrderedDict()
+_l1_lock = threading.Lock()
+# query -> time of its last L1 hit, written back to last_used before eviction
+# so the hottest answers don't look idle in the database
+_l1_touched = {}
+_stats = {
+    "l1_hits": 0, "db_hits": 0, "semantic_hits": 0, "misses": 0,
+    "expired": 0, "stores": 0, "evictions": 0, "embed_failures": 0, "embed_skipped": 0,
+}
+
+# Semantic index: key -> (mode, expires_at, unit vector), plus a matrix of
+# the vectors rebuilt lazily after changes
+_vectors = {}
+_matrix = None
+_matrix_keys = []
+_embed_disabled_until = 0.0
+# Coroutine function returning the bot's pooled aiohttp session; scripts
+# that never set it get a session of their own
+_session_getter = None
+_session = None
+
+
+def normalize_query(query: str) -> str:
+    """Fold case, contractions, punctuation and whitespace so trivial variants share a key."""
+    text = (query or "").lower().replace("\u2019", "'")
+    text = _CONTRACTION_RE.sub(lambda match: CONTRACTIONS[match.group(0)], text)
+    text = _PUNCTUATION_RE.sub(" ", text)
+    return " ".join(text.split())
+
+
+def init_cache():
+    """Open the cache database, upgrading an old table in place (blocking, idempotent)."""
+    global _db
+    with _db_lock:
+        if _db is not None:
+            return
+        _db = sqlite3.connect(CACHE_DB, check_same_thread=False)
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("PRAGMA synchronous=NORMAL")
+        _db.execute(
+            "CREATE TABLE IF NOT EXISTS cache (query TEXT PRIMARY KEY, answer TEXT, ts REAL)"
+        )
+        columns = {row[1] for row in _db.execute("PRAGMA table_info(cache)")}
+        for column, kind in (
+            ("mode", "TEXT"), ("expires_at", "REAL"), ("last_used", "REAL"), ("size", "INTEGER"),
+            ("embedding", "BLOB"),
+        ):
+            if column not in columns:
+                _db.execute(f"ALTER TABLE cache ADD COLUMN {column} {kind}")
+        with _db:
+            # Rows from before expiry existed: their mode is unknown, so give
+            # them the shortest TTL rather than serving stale news forever
+            _db.execute(
+                "UPDATE cache SET expires_at = ts + ?, last_used = ts, size = LENGTH(query) + LENGTH(answer) "
+                "WHERE expires_at IS NULL",
+                (DEFAULT_TTL,),
+            )
+            _db.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+        _db.execute("CREATE INDEX IF NOT EXISTS cache_last_used ON cache (last_used)")
+        _db.execute("CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (expires_at)")
+        # Embeddings are stored as float32 bytes and kept in memory for search
+        for query, mode, expires_at, blob in _db.execute(
+            "SELECT query, mode, expires_at, embedding FROM cache WHERE embedding IS NOT NULL"
+        ):
+            _vectors[query] = (mode, expires_at, np.frombuffer(blob, dtype=np.float32))
+
+
+def _l1_put(query: str, answer: str, expires_at: float):
+    with _l1_lock:
+        _l1[query] = (answer, expires_at)
+        _l1.move_to_end(query)
+        while len(_l1) > L1_MAX_ENTRIES:
+            _l1.popitem(last=False)
+
+
+def get_l1(query: str):
+    """In-memory lookup only; cheap enough to run on the event loop."""
+    with _l1_lock:
+        entry = _l1.get(query)
+        if entry is None:
+            return None
+        answer, expires_at = entry
+        if expires_at <= time.time():
+            del _l1[query]
+            return None
+        _l1.move_to_end(query)
+        _l1_touched[query] = time.time()
+    return answer
+
+
+def _flush_touches():
+    """Write batched L1 hits into last_used. Caller holds _db_lock."""
+    with _l1_lock:
+        touched = list(_l1_touched.items())
+        _l1_touched.clear()
+    if touched:
+        _db.executemany(
+            "UPDATE cache SET last_used = MAX(last_used, ?) WHERE query=?",
+            [(used, query) for query, used in touched],
+        )
+
+
+def get(query: str):
+    """Return the cached answer for a query, or None (blocking)."""
+    answer = get_l1(query)
+    if answer is not None:
+        return answer
+    init_cache()
+    now = time.time()
+    with _db_lock:
+        row = _db.execute("SELECT answer, expires_at FROM cache WHERE query=?", (query,)).fetchone()
+        if row is None:
+            return None
+        answer, expires_at = row
+        if expires_at <= now:
+            with _db:
+                _db.execute("DELETE FROM cache WHERE query=?", (query,))
+            _forget_vector(query)
+            _stats["expired"] += 1
+            return None
+        with _db:
+            _db.execute("UPDATE cache SET last_used=? WHERE query=?", (now, query))
+    _l1_put(query, answer, expires_at)
+    return answer
+
+
+def store(query: str, answer: str, mode: str, vector=None):
+    """
+    Cache an answer for its mode's TTL, evicting old entries over the caps (blocking).
+
+    vector is the query's unit embedding, if it has one, for semantic lookups.
+    """
+    if not answer:
+        return
+    init_cache()
+    now = time.time()
+    expires_at = now + TTLS.get(mode, DEFAULT_TTL)
+    blob = vector.astype(np.float32).tobytes() if vector is not None else None
+    size = len(query.encode()) + len(answer.encode()) + len(blob or b"")
+    with _db_lock:
+        with _db:
+            _db.execute(
+                "INSERT OR REPLACE INTO cache (query, answer, ts, mode, expires_at, last_used, size, embedding) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (query, answer, now, mode, expires_at, now, size, blob),
+            )
+            _evict(now)
+        if vector is not None:
+            _remember_vector(query, mode, expires_at, vector)
+    _stats["stores"] += 1
+    _l1_put(query, answer, expires_at)
+
+
+def _evict(now: float):
+    """Drop expired rows, then least recently used ones over the caps. Caller holds _db_lock."""
+    _db.execute("DELETE FROM cache WHERE expires_at <= ?", (now,))
+    _flush_touches()
+    for query in [query for query, (_mode, expires_at, _vector) in _vectors.items() if expires_at <= now]:
+        _forget_vector(query)
+    rows, total = _db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+    if rows <= MAX_ROWS and total <= MAX_BYTES:
+        return
+    for query, size in _db.execute("SELECT query, size FROM cache ORDER BY last_used").fetchall():
+        if rows <= MAX_ROWS and total <= MAX_BYTES:
+            break
+        _db.execute("DELETE FROM cache WHERE query=?", (query,))
+        with _l1_lock:
+            _l1.pop(query, None)
+        _forget_vector(query)
+        rows -= 1
+        total -= size or 0
+        _stats["evictions"] += 1
+
+
+# -------------------------
+# SEMANTIC LAYER
+# -------------------------
+
+def _remember_vector(key, mode, expires_at, vector):
+    global _matrix
+    _vectors[key] = (mode, expires_at, vector)
+    _matrix = None
+
+
+def _forget_vector(key):
+    global _matrix
+    if _vectors.pop(key, None) is not None:
+        _matrix = None
+
+
+def nearest(vector, mode: str):
+    """Return (key, similarity) of the closest cached query of the same mode, or (None, 0.0)."""
+    global _matrix, _matrix_keys
+    with _db_lock:
+        if _matrix is None:
+            _matrix_keys = list(_vectors)
+            dims = {len(_vectors[key][2]) for key in _matrix_keys}
+            if len(dims) > 1:
+                # The embedding model changed; only the current one's vectors compare
+                _matrix_keys = [key for key in _matrix_keys if len(_vectors[key][2]) == len(vector)]
+            _matrix = (
+                np.stack([_vectors[key][2] for key in _matrix_keys])
+                if _matrix_keys else np.zeros((0, len(vector)), dtype=np.float32)
+            )
+        matrix, keys = _matrix, _matrix_keys
+        now = time.time()
+        eligible = np.array(
+            [key in _vectors and _vectors[key][0] == mode and _vectors[key][1] > now for key in keys],
+            dtype=bool,
+        )
+    if not eligible.any() or matrix.shape[1] != len(vector):
+        return None, 0.0
+    # Rows and query are unit vectors, so the dot product is the cosine similarity
+    scores = np.where(eligible, matrix @ vector, -1.0)
+    best = int(np.argmax(scores))
+    return keys[best], float(scores[best])
+
+
+def use_http_session(getter):
+    """Send embedding requests through the session returned by awaiting getter()."""
+    global _session_getter
+    _session_getter = getter
+
+
+async def _get_session():
+    global _session
+    if _session_getter is not None:
+        return await _session_getter()
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession()
+    return _session
+
+
+async def close():
+    """Close the embedding HTTP session, if this module opened its own."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+async def embed(text: str, guild_id=None, user_id=None, priority=llm_scheduler.INTERACTIVE):
+    """
+    Unit-length float32 embedding of text from Ollama, or None if unavailable.
+
+    The request holds an llm_scheduler slot like any other Ollama call. It is
+    only an optimization, so rather than queue for a slot (and then queue
+    again for the answer) it is skipped while the scheduler is busy.
+    """
+    global _embed_disabled_until
+    if not SEMANTIC_CACHE or time.monotonic() < _embed_disabled_until:
+        return None
+    if not llm_scheduler.has_free_slot():
+        _stats["embed_skipped"] += 1
+        return None
+    url = OLLAMA_BASE_URL.rstrip("/") + "/api/embed"
+    try:
+        async with llm_scheduler.slot(guild_id, user_id, priority):
+            session = await _get_session()
+            async with session.post(
+                url, json={"model": EMBED_MODEL, "input": text}, timeout=EMBED_TIMEOUT
+            ) as response:
+                if response.status != 200:
+                    raise RuntimeError(f"Ollama error {response.status}")
+                data = await response.json()
+        vector = np.asarray(data["embeddings"][0], dtype=np.float32)
+    except Exception as e:
+        _stats["embed_failures"] += 1
+        _embed_disabled_until = time.monotonic() + EMBED_RETRY_AFTER
+        print(f"Semantic cache disabled for {EMBED_RETRY_AFTER}s, embedding failed: {e}")
+        return None
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm else None
+
+
+async def lookup(query: str, mode: str, guild_id=None, user_id=None, priority=llm_scheduler.INTERACTIVE):
+    """
+    Find a cached answer: exact normalized match first, then semantic.
+
+    Returns (answer, vector). answer is None on a miss; pass vector on to
+    save() so the query isn't embedded twice. guild_id, user_id and
+    priority are passed to the embedding request's scheduler slot.
+    """
+    key = normalize_query(query)
+    answer = get_l1(key)
+    if answer is not None:
+        _stats["l1_hits"] += 1
+        return answer, None
+    answer = await asyncio.to_thread(get, key)
+    if answer is not None:
+        _stats["db_hits"] += 1
+        return answer, None
+
+    vector = await embed(key, guild_id, user_id, priority) if len(key) <= SEMANTIC_MAX_CHARS else None
+    if vector is not None:
+        match, similarity = await asyncio.to_thread(nearest, vector, mode)
+        if match is not None and similarity >= SIMILARITY_THRESHOLD:
+            answer = await asyncio.to_thread(get, match)
+            if answer is not None:
+                _stats["semantic_hits"] += 1
+                print(f"Semantic cache hit ({similarity:.3f}): {key!r} ~ {match!r}")
+                return answer, vector
+    _stats["misses"] += 1
+    return None, vector
+
+
+async def save(query: str, answer: str, mode: str, vector=None):
+    """Awaitable store() under the query's normalized key."""
+    await asyncio.to_thread(store, normalize_query(query), answer, mode, vector)
+
+
+def cache_stats() -> dict:
+    """Hit/miss/eviction counters plus current row and byte totals."""
+    init_cache()
+    with _db_lock:
+        rows, total = _db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
+    hits = _stats["l1_hits"] + _stats["db_hits"] + _stats["semantic_hits"]
+    lookups = hits + _stats["misses"]
+    return dict(
+        _stats,
+        rows=rows,
+        bytes=total,
+        l1_entries=len(_l1),
+        vectors=len(_vectors),
+        hit_rate=hits / lookups if lookups else 0.0,
+    )
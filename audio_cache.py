@@ -0,0 +1,512 @@
+import json
+import math
+import os
+import re
+import sqlite3
+import subprocess
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import parse_qs, urlparse
+
+
+# -------------------------
+# CONTENT-ADDRESSED AUDIO CACHE
+# -------------------------
+# Files are named after the extractor's canonical video ID, not the URL or
+# the guild, so every URL form of a track resolves to one shared file. Each
+# quality tier is a separate variant: {key}.{tier}.opus plus a .json sidecar.
+
+DOWNLOAD_DIR = "music_downloads"
+os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+
+# Cache limits
+MAX_CACHE_SIZE_MB = 500  # Maximum size for the downloads folder (500 MB)
+MAX_FILE_AGE_DAYS = 7    # Files not played for this long are deleted
+# Which entry to evict first when space is needed: "lru" or "lfu"
+EVICTION_POLICY = os.getenv("MUSIC_CACHE_POLICY", "lru").lower()
+INDEX_DB = os.path.join(DOWNLOAD_DIR, "cache_index.db")
+
+# Tracks are stored as Discord-ready Opus (48 kHz, 20 ms frames, Ogg) so
+# playback can send the packets as-is without decoding or re-encoding
+AUDIO_EXT = "opus"
+META_EXT = "json"
+SAMPLE_RATE = 48000
+
+# Gain baked into files whose loudness is not known yet (streams being
+# cached as they play): the level heard at the default volume
+CACHE_GAIN = 0.4
+
+# Loudness normalization (EBU R128). Each download is measured once and the
+# gain that brings it to the target is baked into the cached file, so
+# playback needs no analysis and no extra gain stage. The default target is
+# where CACHE_GAIN put a typical YouTube master (about -14 LUFS).
+LOUDNESS_TARGET = float(os.getenv("MUSIC_LOUDNESS_TARGET", "-22"))  # LUFS
+TRUE_PEAK_LIMIT = -1.5  # dBTP; boosts never push peaks above this
+MAX_BOOST_DB = 12.0
+
+# Quality tiers, lowest first. "format" picks the source stream yt-dlp
+# fetches (the low tier downloads a smaller stream), "bitrate" is the Opus
+# bitrate in kbps used for the cached file and for live encoding.
+QUALITY_TIERS = {
+    "low": {"format": "bestaudio[abr<=64]/worstaudio/bestaudio/best", "bitrate": 48},
+    "medium": {"format": "bestaudio[abr<=128]/bestaudio/best", "bitrate": 96},
+    "high": {"format": "bestaudio/best", "bitrate": 160},
+}
+TIER_ORDER = list(QUALITY_TIERS)
+
+
+def cache_codec_args(tier: str, gain_db: float = None) -> list:
+    """
+    FFmpeg output arguments that produce a cache-format file for a tier.
+
+    gain_db is the normalization gain; without it the fixed CACHE_GAIN is used.
+    """
+    volume = CACHE_GAIN if gain_db is None else f"{gain_db:.2f}dB"
+    return [
+        "-af", f"volume={volume}",
+        "-c:a", "libopus", "-b:a", f"{QUALITY_TIERS[tier]['bitrate']}k",
+        "-ar", str(SAMPLE_RATE), "-ac", "2",
+        "-application", "audio", "-frame_duration", "20",
+        "-f", "ogg",
+    ]
+
+_YOUTUBE_HOSTS = {
+    "youtube.com",
+    "www.youtube.com",
+    "m.youtube.com",
+    "music.youtube.com",
+    "youtube-nocookie.com",
+    "www.youtube-nocookie.com",
+}
+_YOUTUBE_ID_RE = re.compile(r"^[A-Za-z0-9_-]{11}$")
+_KEY_UNSAFE_RE = re.compile(r"[^A-Za-z0-9_-]")
+
+
+def youtube_video_id(url: str):
+    """Pull the 11-char video ID out of any common YouTube URL form, or None."""
+    try:
+        parsed = urlparse(url.strip())
+    except ValueError:
+        return None
+
+    host = (parsed.hostname or "").lower()
+    candidate = None
+
+    if host in ("youtu.be", "www.youtu.be"):
+        candidate = parsed.path.lstrip("/").split("/")[0]
+    elif host in _YOUTUBE_HOSTS:
+        if parsed.path == "/watch":
+            candidate = (parse_qs(parsed.query).get("v") or [None])[0]
+        else:
+            parts = parsed.path.strip("/").split("/")
+            if len(parts) >= 2 and parts[0] in ("shorts", "embed", "live", "v"):
+                candidate = parts[1]
+
+    if candidate and _YOUTUBE_ID_RE.match(candidate):
+        return candidate
+    return None
+
+
+def make_key(extractor: str, video_id: str) -> str:
+    """Build a filesystem-safe cache key from an extractor name and video ID."""
+    extractor = _KEY_UNSAFE_RE.sub("_", (extractor or "generic").lower())
+    video_id = _KEY_UNSAFE_RE.sub("_", str(video_id))
+    return f"{extractor}-{video_id}"
+
+
+def key_from_url(url: str):
+    """Return the cache key for a URL when it can be derived offline, else None."""
+    video_id = youtube_video_id(url)
+    if video_id:
+        return make_key("youtube", video_id)
+    return None
+
+
+def key_from_info(info: dict) -> str:
+    """Return the cache key for a yt-dlp info dict."""
+    extractor = info.get("extractor_key") or info.get("ie_key") or info.get("extractor")
+    return make_key(extractor, info["id"])
+
+
+def entry_name(key: str, tier: str) -> str:
+    """File stem of one cached variant of a track."""
+    return f"{key}.{tier}"
+
+
+def audio_path(name: str) -> str:
+    return os.path.join(DOWNLOAD_DIR, f"{name}.{AUDIO_EXT}")
+
+
+def meta_path(name: str) -> str:
+    return os.path.join(DOWNLOAD_DIR, f"{name}.{META_EXT}")
+
+
+def read_metadata(name: str):
+    """Load the sidecar for a cached variant, or None if missing/corrupt."""
+    try:
+        with open(meta_path(name), "r", encoding="utf-8") as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_sidecar(name: str, meta: dict):
+    tmp = meta_path(name) + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as fh:
+        json.dump(meta, fh)
+    os.replace(tmp, meta_path(name))
+
+
+def write_metadata(key: str, tier: str, info: dict, file_path: str, loudness: dict = None) -> dict:
+    """Write the sidecar describing a cached audio file and return it."""
+    name = entry_name(key, tier)
+    meta = {
+        "key": key,
+        "tier": tier,
+        "id": info.get("id"),
+        "extractor": info.get("extractor_key") or info.get("extractor"),
+        "url": info.get("webpage_url") or info.get("original_url"),
+        "title": info.get("title", "Unknown Title"),
+        "duration": info.get("duration"),
+        "codec": "opus",
+        "bitrate": QUALITY_TIERS[tier]["bitrate"],
+        "container": "ogg",
+        "sample_rate": SAMPLE_RATE,
+        "size": os.path.getsize(file_path),
+        "created": time.time(),
+        # Measured source loudness and the gain baked in; None until measured
+        "loudness": loudness,
+    }
+    _write_sidecar(name, meta)
+    return meta
+
+
+def analyze_loudness(path: str):
+    """
+    Measure integrated loudness, true peak and loudness range (blocking).
+
+    Returns {"integrated", "true_peak", "lra"} or None if FFmpeg could not
+    measure the file (e.g. it is silent).
+    """
+    result = subprocess.run(
+        ["ffmpeg", "-hide_banner", "-nostats", "-i", path, "-vn",
+         "-af", "loudnorm=print_format=json", "-f", "null", "-"],
+        stdin=subprocess.DEVNULL,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        return None
+    # loudnorm prints its measurements as the last JSON object on stderr
+    try:
+        stderr = result.stderr
+        data = json.loads(stderr[stderr.rindex("{"):stderr.rindex("}") + 1])
+        loudness = {
+            "integrated": float(data["input_i"]),
+            "true_peak": float(data["input_tp"]),
+            "lra": float(data["input_lra"]),
+        }
+    except (ValueError, KeyError):
+        return None
+    if not math.isfinite(loudness["integrated"]):
+        return None
+    return loudness
+
+
+def normalization_gain(loudness: dict) -> float:
+    """Gain in dB that brings measured audio to LOUDNESS_TARGET without clipping."""
+    gain = LOUDNESS_TARGET - loudness["integrated"]
+    return round(min(gain, TRUE_PEAK_LIMIT - loudness["true_peak"], MAX_BOOST_DB), 2)
+
+
+def encode(source_path: str, dest_path: str, tier: str, gain_db: float = None):
+    """
+    Transcode any audio file into the cache format (blocking).
+
+    Without gain_db the source is measured first and encoded at its
+    normalization gain. Returns the loudness record for the sidecar, or None
+    if the file could not be measured and CACHE_GAIN was used instead.
+    """
+    loudness = None
+    if gain_db is None:
+        loudness = analyze_loudness(source_path)
+        if loudness:
+            gain_db = normalization_gain(loudness)
+            loudness = dict(loudness, gain_db=gain_db, target=LOUDNESS_TARGET)
+    subprocess.run(
+        ["ffmpeg", "-loglevel", "error", "-y", "-i", source_path, "-vn",
+         *cache_codec_args(tier, gain_db), dest_path],
+        check=True,
+        stdin=subprocess.DEVNULL,
+    )
+    return loudness
+
+
+def normalize(key: str, tier: str):
+    """
+    Bring a variant cached at the fixed CACHE_GAIN to the loudness target (blocking).
+
+    Used for tracks cached while they streamed, which could not be measured
+    before encoding. The file is re-encoded only if the correction is audible.
+    """
+    name = entry_name(key, tier)
+    path = audio_path(name)
+    meta = read_metadata(name)
+    if not meta or meta.get("loudness") or not os.path.exists(path):
+        return
+    measured = analyze_loudness(path)
+    if measured is None:
+        return
+
+    # Work out what the source measured before CACHE_GAIN was applied
+    applied_db = 20 * math.log10(CACHE_GAIN)
+    loudness = {
+        "integrated": round(measured["integrated"] - applied_db, 2),
+        "true_peak": round(measured["true_peak"] - applied_db, 2),
+        "lra": measured["lra"],
+    }
+    gain_db = normalization_gain(loudness)
+    correction = gain_db - applied_db
+    if abs(correction) >= 0.5:
+        temp_path = os.path.join(DOWNLOAD_DIR, f"temp_{name}.norm.{AUDIO_EXT}")
+        encode(path, temp_path, tier, gain_db=correction)
+        # Readers that already opened the old file keep reading it
+        os.replace(temp_path, path)
+        _register(name, os.path.getsize(path))
+        meta["size"] = os.path.getsize(path)
+    meta["loudness"] = dict(loudness, gain_db=gain_db, target=LOUDNESS_TARGET)
+    _write_sidecar(name, meta)
+
+
+def publish(key: str, tier: str, info: dict, temp_path: str, loudness: dict = None) -> str:
+    """
+    Move a finished temp file into the cache as the given tier variant.
+
+    The sidecar is written first and the audio appears via an atomic rename,
+    so readers never see a partial file under the cache name.
+    """
+    name = entry_name(key, tier)
+    size = os.path.getsize(temp_path)
+    # Make room first so the cache never goes over its size limit
+    _evict_for(size)
+    write_metadata(key, tier, info, temp_path, loudness)
+    os.replace(temp_path, audio_path(name))
+    _register(name, size)
+    return audio_path(name)
+
+
+def lookup(key: str, tier: str = None, touch: bool = True):
+    """
+    Return (file_path, metadata) for a cached track, or (None, None).
+
+    With a tier, the requested variant is preferred and any higher tier that
+    is already cached is accepted instead of downloading again. Without one,
+    the best cached variant is returned. touch=False skips the access update
+    for metadata-only lookups.
+    """
+    tiers = TIER_ORDER[TIER_ORDER.index(tier):] if tier else reversed(TIER_ORDER)
+    for candidate in tiers:
+        name = entry_name(key, candidate)
+        path = audio_path(name)
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            if touch:
+                _touch(name)
+            return path, read_metadata(name) or {}
+    return None, None
+
+
+def remove(name: str):
+    """Delete a cached variant and its sidecar."""
+    global _total_bytes
+    for path in (audio_path(name), meta_path(name)):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    with _index_lock:
+        entry = _index.pop(name, None)
+        if entry:
+            _total_bytes -= entry["size"]
+            _dirty.add(name)
+
+
+# -------------------------
+# CACHE INDEX
+# -------------------------
+# Size, last access and hit count of every cached variant are kept in memory
+# and persisted to SQLite, so the cache never needs a directory walk. Entries
+# being played are pinned and never evicted. Eviction runs incrementally
+# whenever a new file is published.
+
+_index = {}                # name -> {"size", "last_access", "hits"}
+_pins = defaultdict(int)   # name -> number of players using it
+_dirty = set()             # names whose row needs writing (or deleting)
+_index_lock = threading.RLock()
+_total_bytes = 0
+_db = None
+_stats = {"evictions": 0, "evicted_bytes": 0}
+
+
+def init_index():
+    """
+    Load the index from SQLite and reconcile it with the directory (blocking).
+
+    Runs once at startup; this is the only time the cache directory is
+    listed. Leftover temp files from a previous run are removed, and so is
+    audio from older cache layouts (e.g. {guild}_{id}.mp3 or {key}.mp3),
+    which the index can't account for and would never evict. SQLite
+    databases kept alongside the cache are left alone.
+    """
+    global _db, _total_bytes
+    with _index_lock:
+        if _db is not None:
+            return
+        _db = sqlite3.connect(INDEX_DB, check_same_thread=False)
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute(
+            "CREATE TABLE IF NOT EXISTS entries "
+            "(name TEXT PRIMARY KEY, size INTEGER, last_access REAL, hits INTEGER)"
+        )
+        rows = {
+            name: {"size": size, "last_access": last_access, "hits": hits}
+            for name, size, last_access, hits in _db.execute(
+                "SELECT name, size, last_access, hits FROM entries"
+            )
+        }
+
+        on_disk = set()
+        sidecars = set()
+        for filename in os.listdir(DOWNLOAD_DIR):
+            file_path = os.path.join(DOWNLOAD_DIR, filename)
+            stem, ext = os.path.splitext(filename)
+            if filename.endswith((".db", ".db-wal", ".db-shm", ".db-journal")) or not os.path.isfile(file_path):
+                continue
+            if filename.startswith("temp_"):
+                os.remove(file_path)
+            elif ext == f".{META_EXT}":
+                sidecars.add(stem)
+            elif ext != f".{AUDIO_EXT}" or os.path.splitext(stem)[1][1:] not in QUALITY_TIERS:
+                print(f"Removing {filename} from an older cache format")
+                os.remove(file_path)
+            else:
+                on_disk.add(stem)
+                if stem not in rows:
+                    stat = os.stat(file_path)
+                    rows[stem] = {"size": stat.st_size, "last_access": stat.st_mtime, "hits": 0}
+                    _dirty.add(stem)
+
+        for name in set(rows) - on_disk:
+            del rows[name]
+            _dirty.add(name)
+        # Sidecars whose audio never made it (or was deleted by hand)
+        for name in sidecars - on_disk:
+            os.remove(meta_path(name))
+
+        _index.update(rows)
+        _total_bytes = sum(entry["size"] for entry in _index.values())
+        _flush()
+
+
+def _flush():
+    """Write dirty index rows to SQLite. Caller holds _index_lock."""
+    if _db is None or not _dirty:
+        return
+    with _db:
+        for name in _dirty:
+            entry = _index.get(name)
+            if entry is None:
+                _db.execute("DELETE FROM entries WHERE name=?", (name,))
+            else:
+                _db.execute(
+                    "INSERT OR REPLACE INTO entries (name, size, last_access, hits) VALUES (?, ?, ?, ?)",
+                    (name, entry["size"], entry["last_access"], entry["hits"]),
+                )
+    _dirty.clear()
+
+
+def _register(name: str, size: int):
+    global _total_bytes
+    with _index_lock:
+        old = _index.get(name)
+        if old:
+            _total_bytes -= old["size"]
+        _index[name] = {"size": size, "last_access": time.time(), "hits": 0}
+        _total_bytes += size
+        _dirty.add(name)
+        _flush()
+
+
+def _touch(name: str):
+    # Access updates stay in memory; maintain() persists them in batches
+    with _index_lock:
+        entry = _index.get(name)
+        if entry:
+            entry["last_access"] = time.time()
+            entry["hits"] += 1
+            _dirty.add(name)
+
+
+def _eviction_order(name: str):
+    entry = _index[name]
+    if EVICTION_POLICY == "lfu":
+        return entry["hits"], entry["last_access"]
+    return entry["last_access"], entry["hits"]
+
+
+def _evict_for(incoming: int):
+    """Evict unpinned entries until incoming bytes fit under the size limit."""
+    limit = MAX_CACHE_SIZE_MB * 1024 * 1024
+    with _index_lock:
+        if _total_bytes + incoming <= limit:
+            return
+        candidates = sorted((name for name in _index if not _pins.get(name)), key=_eviction_order)
+        for name in candidates:
+            if _total_bytes + incoming <= limit:
+                break
+            _stats["evictions"] += 1
+            _stats["evicted_bytes"] += _index[name]["size"]
+            remove(name)
+            print(f"Evicted cached track: {name}")
+        _flush()
+
+
+def pin(file_path: str):
+    """Protect a cached file from eviction while it is being played."""
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    with _index_lock:
+        _pins[name] += 1
+
+
+def unpin(file_path: str):
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    with _index_lock:
+        _pins[name] -= 1
+        if _pins[name] <= 0:
+            del _pins[name]
+
+
+def maintain():
+    """
+    Periodic upkeep (blocking): drop entries not played for MAX_FILE_AGE_DAYS,
+    enforce the size limit and persist batched access updates.
+    """
+    cutoff = time.time() - MAX_FILE_AGE_DAYS * 86400
+    with _index_lock:
+        for name in [n for n, e in _index.items() if e["last_access"] < cutoff and not _pins.get(n)]:
+            remove(name)
+            print(f"Deleted old file: {name}")
+        _evict_for(0)
+        _flush()
+
+
+def cache_stats() -> dict:
+    """Snapshot of cache size and eviction counters."""
+    with _index_lock:
+        return dict(
+            _stats,
+            entries=len(_index),
+            total_bytes=_total_bytes,
+            pinned=len(_pins),
+            policy=EVICTION_POLICY,
+        )
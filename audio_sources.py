@@ -0,0 +1,303 @@
+import audioop
+import os
+import shlex
+import subprocess
+import threading
+import time
+
+import discord
+from discord.oggparse import OggStream
+
+
+# -------------------------
+# CUSTOM AUDIO SOURCES
+# -------------------------
+
+STREAM_BEFORE_OPTIONS = ["-reconnect", "1", "-reconnect_streamed", "1", "-reconnect_delay_max", "5"]
+
+# Discord voice frames are 20 ms
+FRAME_SECONDS = 0.02
+
+
+class FollowFile:
+    """
+    Read-only file that waits for more data while a writer is still appending.
+
+    writing() tells whether the writer is still running; reads give up after
+    timeout seconds without new data.
+    """
+
+    def __init__(self, path, writing, poll=0.02, timeout=15.0):
+        self._file = open(path, "rb")
+        self._writing = writing
+        self._poll = poll
+        self._timeout = timeout
+
+    def read(self, size):
+        data = b""
+        deadline = time.monotonic() + self._timeout
+        while len(data) < size:
+            chunk = self._file.read(size - len(data))
+            if chunk:
+                data += chunk
+                deadline = time.monotonic() + self._timeout
+            elif not self._writing():
+                # The writer may have appended its last bytes just before exiting
+                chunk = self._file.read(size - len(data))
+                if not chunk:
+                    break
+                data += chunk
+            elif time.monotonic() > deadline:
+                break
+            else:
+                time.sleep(self._poll)
+        return data
+
+    def close(self):
+        self._file.close()
+
+
+class OggOpusFileAudio(discord.AudioSource):
+    """
+    Opus passthrough for cached Ogg Opus files.
+
+    Packets are read straight from the file and sent to Discord as-is, so
+    there is no FFmpeg process and no per-frame decode or encode. Cached files
+    use 20 ms frames, which lets start= skip ahead by packet count. Pass
+    writing= to read a file that is still being written.
+    """
+
+    def __init__(self, path, start=0.0, writing=None):
+        self._file = FollowFile(path, writing) if writing else open(path, "rb")
+        self._packets = OggStream(self._file).iter_packets()
+        self.start = start
+        self._skip = int(start / FRAME_SECONDS)
+
+    def read(self):
+        for packet in self._packets:
+            # Identification and comment headers are not audio
+            if packet.startswith((b"OpusHead", b"OpusTags")):
+                continue
+            if self._skip:
+                self._skip -= 1
+                continue
+            return packet
+        return b""
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self._file.close()
+
+
+class SharedOpusStream:
+    """
+    One FFmpeg process encoding a remote stream into a growing Ogg Opus file.
+
+    Any number of listeners read the file as Opus passthrough, each from its
+    own offset, so the decode and encode happen once per track however many
+    guilds play it. The file is handed to on_cached(path) when the encode
+    finishes cleanly; if every listener leaves first, FFmpeg is stopped and
+    the file deleted. on_done() is called once the stream is over either way.
+    """
+
+    def __init__(self, stream_url, path, *, cache_codec_args, on_cached=None, on_done=None):
+        self.path = path
+        self.on_cached = on_cached
+        self.on_done = on_done
+        self.listeners = 0
+        self._lock = threading.Lock()
+        # Listeners may open the file before FFmpeg has created it
+        open(path, "ab").close()
+        self.process = subprocess.Popen(
+            ["ffmpeg", "-loglevel", "warning", *STREAM_BEFORE_OPTIONS, "-i", stream_url,
+             "-map", "0:a", "-vn", *cache_codec_args, "-y", path],
+            stdin=subprocess.DEVNULL,
+        )
+        threading.Thread(target=self._wait, name="shared-stream", daemon=True).start()
+
+    def writing(self):
+        return self.process.poll() is None
+
+    def open(self, start=0.0):
+        """Return a new listener source starting start seconds in."""
+        source = SharedStreamAudio(self, start)
+        with self._lock:
+            self.listeners += 1
+        return source
+
+    def release(self):
+        with self._lock:
+            self.listeners -= 1
+            abandoned = self.listeners == 0 and self.writing()
+        if abandoned:
+            self.process.terminate()
+
+    def _wait(self):
+        complete = self.process.wait() == 0
+        try:
+            if complete and self.on_cached:
+                try:
+                    self.on_cached(self.path)
+                    return
+                except Exception as e:
+                    print(f"Failed to cache shared stream: {e}")
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+        finally:
+            if self.on_done:
+                self.on_done()
+
+
+class SharedStreamAudio(OggOpusFileAudio):
+    """One listener of a SharedOpusStream."""
+
+    def __init__(self, shared, start=0.0):
+        # Nothing to release if opening the file fails
+        self._released = True
+        super().__init__(shared.path, start, writing=shared.writing)
+        self.shared = shared
+        self._released = False
+
+    def cleanup(self):
+        if not self._released:
+            self._released = True
+            super().cleanup()
+            self.shared.release()
+
+
+class OpusDecodeSource(discord.AudioSource):
+    """Decode an Opus passthrough source back to PCM, e.g. to change its volume."""
+
+    def __init__(self, original):
+        self.original = original
+        self._decoder = discord.opus.Decoder()
+
+    def read(self):
+        packet = self.original.read()
+        return self._decoder.decode(packet) if packet else b""
+
+    def cleanup(self):
+        self.original.cleanup()
+
+
+class CachingFFmpegPCMAudio(discord.FFmpegPCMAudio):
+    """
+    Play a remote stream while FFmpeg writes the same audio to a cache file.
+
+    One FFmpeg process reads the stream once and has two outputs: PCM on
+    stdout for Discord and an encoded file on disk. on_cached(path) is called
+    only if the stream played to the end and FFmpeg exited cleanly; a skipped
+    or failed stream leaves no file behind.
+    """
+
+    def __init__(self, stream_url, cache_path, *, cache_codec_args, options=None, on_cached=None):
+        self.cache_path = cache_path
+        self.on_cached = on_cached
+        self.reached_eof = False
+
+        args = [
+            "-loglevel", "warning",
+            *STREAM_BEFORE_OPTIONS,
+            "-i", stream_url,
+            # Output 1: the cache file
+            "-map", "0:a", "-vn", *cache_codec_args, "-y", cache_path,
+            # Output 2: PCM for Discord
+            "-map", "0:a", "-vn", *shlex.split(options or ""),
+            "-f", "s16le", "-ar", "48000", "-ac", "2", "pipe:1",
+        ]
+        discord.FFmpegAudio.__init__(
+            self, stream_url, executable="ffmpeg", args=args, stdin=subprocess.DEVNULL, stderr=None
+        )
+
+    def read(self):
+        data = super().read()
+        if not data:
+            self.reached_eof = True
+        return data
+
+    def cleanup(self):
+        process = self._process
+        complete = False
+        if self.reached_eof and process:
+            # stdout hits EOF slightly before FFmpeg finalises the file output
+            try:
+                complete = process.wait(timeout=10) == 0
+            except subprocess.TimeoutExpired:
+                complete = False
+        super().cleanup()
+
+        if complete and self.on_cached:
+            try:
+                self.on_cached(self.cache_path)
+                return
+            except Exception as e:
+                print(f"Failed to cache streamed track: {e}")
+        try:
+            os.remove(self.cache_path)
+        except FileNotFoundError:
+            pass
+
+
+class TimedSource(discord.AudioSource):
+    """
+    Pass-through source that tracks playback position and reports how long
+    it took to produce the first frame (pass on_first_frame=None to skip).
+    """
+
+    def __init__(self, original, started_at, on_first_frame, offset=0.0):
+        self.original = original
+        self.started_at = started_at
+        self.on_first_frame = on_first_frame
+        self.offset = offset
+        self.frames = 0
+
+    @property
+    def position(self):
+        """Seconds into the track that have been sent so far."""
+        return self.offset + self.frames * FRAME_SECONDS
+
+    def read(self):
+        data = self.original.read()
+        if data:
+            if not self.frames and self.on_first_frame:
+                self.on_first_frame(time.monotonic() - self.started_at)
+            self.frames += 1
+        return data
+
+    def is_opus(self):
+        return self.original.is_opus()
+
+    def cleanup(self):
+        self.original.cleanup()
+
+
+class LiveGainSource(discord.AudioSource):
+    """
+    Volume stage for PCM sources whose FFmpeg process already applied a gain.
+
+    The guild's volume is baked into FFmpeg's filter when a source opens, so
+    this stage is normally at unity and hands frames through untouched. Only
+    a volume change on a live stream scales frames here, in C via audioop.
+    """
+
+    def __init__(self, original, applied=1.0):
+        self.original = original
+        self.applied = applied
+        self.gain = 1.0
+
+    def set_volume(self, volume):
+        """Set the total gain wanted, relative to the source's baked-in gain."""
+        self.gain = min(volume / self.applied, 2.0)
+
+    def read(self):
+        data = self.original.read()
+        if self.gain == 1.0 or not data:
+            return data
+        return audioop.mul(data, 2, self.gain)
+
+    def cleanup(self):
+        self.original.cleanup()
@@ -0,0 +1,521 @@
+import argparse
+import asyncio
+import functools
+import http.server
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from types import SimpleNamespace
+
+import discord
+import yt_dlp
+
+
+# -------------------------
+# MUSIC PIPELINE BENCHMARK
+# -------------------------
+# Drives the real !play / play_next / download_audio / cache code against a
+# fake yt-dlp extractor that serves generated tracks from a local HTTP
+# server, and a stub voice client that reads frames in real time like
+# Discord's player thread. Reports enqueue-to-first-audio, gaps between
+# tracks and CPU per concurrent stream, so changes to the music path can be
+# compared on a normal Linux box before deploying.
+#
+# Runs in a throwaway directory, so the real music_downloads cache and state
+# database are never touched. Needs ffmpeg with libopus on PATH.
+
+FRAME_SECONDS = 0.02
+BENCH_ID_PREFIX = "bench"
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a list of numbers."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def report(name, samples, unit="ms", scale=1000):
+    if not samples:
+        print(f"{name:<34} (no samples)")
+        return
+    print(
+        f"{name:<34} p50 {percentile(samples, 50) * scale:>8.1f} {unit}  "
+        f"p99 {percentile(samples, 99) * scale:>8.1f} {unit}  "
+        f"max {max(samples) * scale:>8.1f} {unit}  (n={len(samples)})"
+    )
+
+
+def video_id(index):
+    """An 11-character ID, so audio_cache keys it like a real YouTube video."""
+    return f"{BENCH_ID_PREFIX}{index:06d}"
+
+
+def video_url(index):
+    return f"https://www.youtube.com/watch?v={video_id(index)}"
+
+
+# -------------------------
+# FAKE EXTRACTOR
+# -------------------------
+
+class TrackServer:
+    """Generates test tracks and serves them over HTTP like a media CDN."""
+
+    def __init__(self, directory, seconds):
+        self.directory = directory
+        self.seconds = seconds
+        handler = functools.partial(_QuietHandler, directory=directory)
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+
+    def path(self, vid):
+        """Local file for a video ID, generated the first time it is asked for."""
+        path = os.path.join(self.directory, f"{vid}.webm")
+        if not os.path.exists(path):
+            # A different tone per track so loudness analysis has real work to do
+            frequency = 220 + (sum(map(ord, vid)) % 40) * 20
+            subprocess.run(
+                [
+                    "ffmpeg", "-v", "error", "-y", "-f", "lavfi",
+                    "-i", f"sine=frequency={frequency}:duration={self.seconds}:sample_rate=48000",
+                    "-ac", "2", "-c:a", "libopus", "-b:a", "128k", path,
+                ],
+                check=True,
+            )
+        return path
+
+    def url(self, vid):
+        self.path(vid)
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/{vid}.webm"
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeYoutubeDL:
+    """
+    Stand-in for yt_dlp.YoutubeDL that answers from the TrackServer.
+
+    Extractions sleep for the configured latency to mimic a YouTube round
+    trip; downloads copy the file into the profile's outtmpl at the
+    configured throughput.
+    """
+
+    server = None
+    latency = 0.3
+    throughput = 2 * 1024 * 1024  # bytes per second
+    calls = defaultdict(int)
+
+    def __init__(self, params=None):
+        self.params = dict(params or {})
+
+    def _info(self, url):
+        vid = url.rsplit("=", 1)[-1].rsplit("/", 1)[-1]
+        if not vid.startswith(BENCH_ID_PREFIX):
+            raise yt_dlp.utils.DownloadError(f"ERROR: [youtube] {vid}: Video unavailable")
+        return {
+            "id": vid,
+            "title": f"Bench track {vid[len(BENCH_ID_PREFIX):]}",
+            "extractor_key": "Youtube",
+            "webpage_url": url,
+            "duration": self.server.seconds,
+            "format_id": "251",
+            "ext": "webm",
+            "url": self.server.url(vid),
+        }
+
+    def _progress(self, status):
+        for hook in self.params.get("progress_hooks", []):
+            hook({"status": status})
+
+    def _download(self, info):
+        source = self.server.path(info["id"])
+        target = self.params["outtmpl"] % info
+        size = os.path.getsize(source)
+        self._progress("downloading")
+        time.sleep(size / self.throughput)
+        shutil.copyfile(source, target)
+        self._progress("finished")
+        info["requested_downloads"] = [{"filepath": target}]
+        return info
+
+    def extract_info(self, url, download=True, **kwargs):
+        FakeYoutubeDL.calls["extract"] += 1
+        time.sleep(self.latency)
+        info = self._info(url)
+        if download:
+            FakeYoutubeDL.calls["download"] += 1
+            return self._download(info)
+        return info
+
+    def process_ie_result(self, info, download=True, **kwargs):
+        if download:
+            FakeYoutubeDL.calls["download"] += 1
+            return self._download(info)
+        return info
+
+
+# -------------------------
+# STUB DISCORD OBJECTS
+# -------------------------
+
+class StubPlayer(threading.Thread):
+    """Reads one frame every 20 ms like discord.player.AudioPlayer."""
+
+    def __init__(self, voice_client, source, after):
+        super().__init__(daemon=True)
+        self.voice_client = voice_client
+        self.source = source
+        self.after = after
+        self._end = threading.Event()
+        self._resumed = threading.Event()
+        self._resumed.set()
+        self.error = None
+
+    def run(self):
+        try:
+            self._do_run()
+        except Exception as exc:
+            self.error = exc
+            self.stop()
+        finally:
+            if self.after is not None:
+                try:
+                    self.after(self.error)
+                except Exception as exc:
+                    print(f"after callback failed: {exc}")
+            self.source.cleanup()
+            self.voice_client.bench.track_ends += 1
+
+    def _do_run(self):
+        next_frame = time.perf_counter()
+        first = True
+        while not self._end.is_set():
+            if not self._resumed.is_set():
+                self._resumed.wait()
+                next_frame = time.perf_counter()
+                continue
+            started = time.perf_counter()
+            data = self.source.read()
+            self.voice_client.read_time.append(time.perf_counter() - started)
+            if not data:
+                # Like discord.py: stopped before the after callback runs
+                self.stop()
+                break
+            self.voice_client.on_frame(first)
+            first = False
+            next_frame += FRAME_SECONDS
+            time.sleep(max(0.0, next_frame - time.perf_counter()))
+
+    def stop(self):
+        self._end.set()
+        self._resumed.set()
+
+    def is_playing(self):
+        return self._resumed.is_set() and not self._end.is_set()
+
+
+class StubVoiceClient:
+    """Just enough of discord.VoiceClient for the music commands."""
+
+    def __init__(self, guild, bench):
+        self.guild = guild
+        self.bench = bench
+        self.channel = SimpleNamespace(id=guild.id * 10, name="bench-voice")
+        self._player = None
+        self._connected = True
+        self._last_frame_at = None
+        self.read_time = []
+
+    def play(self, source, *, after=None, **kwargs):
+        if self.is_playing():
+            raise discord.ClientException("Already playing audio.")
+        self._player = StubPlayer(self, source, after)
+        self._player.start()
+
+    def on_frame(self, first):
+        now = time.perf_counter()
+        if first:
+            self.bench.first_audio(self.guild.id, now, self._last_frame_at)
+        self._last_frame_at = now
+        self.bench.frames += 1
+
+    @property
+    def source(self):
+        return self._player.source if self._player else None
+
+    @source.setter
+    def source(self, value):
+        if self._player:
+            self._player.source = value
+
+    def is_playing(self):
+        return self._player is not None and self._player.is_playing()
+
+    def is_paused(self):
+        return self._player is not None and not self._player._resumed.is_set()
+
+    def is_connected(self):
+        return self._connected
+
+    def stop(self):
+        if self._player:
+            self._player.stop()
+
+    def pause(self):
+        if self._player:
+            self._player._resumed.clear()
+
+    def resume(self):
+        if self._player:
+            self._player._resumed.set()
+
+    async def disconnect(self, force=False):
+        self.stop()
+        self._connected = False
+        self.guild.voice_client = None
+
+
+class StubMessage:
+    def __init__(self, content):
+        self.content = content
+
+    async def edit(self, content=None, **kwargs):
+        self.content = content
+
+    async def delete(self):
+        pass
+
+
+class StubContext:
+    """A command context for one guild and text channel."""
+
+    def __init__(self, guild_id, bench):
+        self.guild = SimpleNamespace(id=guild_id, voice_client=None, roles=[])
+        self.guild.voice_client = StubVoiceClient(self.guild, bench)
+        self.channel = SimpleNamespace(id=guild_id * 10 + 1, name="bench-text")
+        self.author = SimpleNamespace(voice=None, roles=[])
+        self.messages = []
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    async def send(self, content=None, **kwargs):
+        message = StubMessage(content)
+        self.messages.append(message)
+        return message
+
+    def typing(self):
+        return _NoTyping()
+
+
+class _NoTyping:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+# -------------------------
+# SCENARIOS
+# -------------------------
+
+class Bench:
+    def __init__(self, bot_module):
+        self.bot = bot_module
+        self.reset()
+
+    def reset(self):
+        self.enqueued_at = {}
+        self.first_audio_latency = []
+        self.gaps = []
+        self.frames = 0
+        self.track_ends = 0
+        self.bot.ttfa_samples.clear()
+        self.bot.gap_samples.clear()
+
+    def first_audio(self, guild_id, now, last_frame_at):
+        enqueued = self.enqueued_at.pop(guild_id, None)
+        if enqueued is not None:
+            self.first_audio_latency.append(now - enqueued)
+        if last_frame_at is not None:
+            self.gaps.append(now - last_frame_at - FRAME_SECONDS)
+
+    async def play_guild(self, ctx, first_track, tracks):
+        for index in range(first_track, first_track + tracks):
+            if index == first_track:
+                self.enqueued_at[ctx.guild.id] = time.perf_counter()
+            await self.bot.play.callback(ctx, query=video_url(index))
+
+    def finished(self, contexts):
+        for ctx in contexts:
+            guild_id = ctx.guild.id
+            if self.bot.music_queues.get(guild_id) or ctx.voice_client.is_playing():
+                return False
+            if self.bot.player_states.get(guild_id, "idle") != "idle":
+                return False
+        return True
+
+    async def run_playback(self, name, guilds, tracks, seconds, first_track):
+        """Every guild queues its own tracks at once and plays them to the end."""
+        self.reset()
+        contexts = [StubContext(1000 + guild, self) for guild in range(guilds)]
+        cpu_started = resource.getrusage(resource.RUSAGE_SELF)
+        children_started = resource.getrusage(resource.RUSAGE_CHILDREN)
+        wall_started = time.perf_counter()
+
+        await asyncio.gather(*(
+            self.play_guild(ctx, first_track + guild * tracks, tracks)
+            for guild, ctx in enumerate(contexts)
+        ))
+        deadline = time.perf_counter() + tracks * (seconds + 30) + 60
+        while not self.finished(contexts):
+            if time.perf_counter() > deadline:
+                print("⚠️ Timed out waiting for playback to finish")
+                break
+            await asyncio.sleep(0.1)
+        # Let after callbacks, cache publishes and FFmpeg reaping settle
+        await asyncio.sleep(1.0)
+
+        wall = time.perf_counter() - wall_started
+        cpu = _cpu_seconds(resource.getrusage(resource.RUSAGE_SELF), cpu_started)
+        children = _cpu_seconds(resource.getrusage(resource.RUSAGE_CHILDREN), children_started)
+        streamed = self.frames * FRAME_SECONDS
+
+        print(f"\n▶️ {name}: {guilds} guilds x {tracks} tracks of {seconds}s")
+        print("-" * 40)
+        report("enqueue -> first audio", self.first_audio_latency)
+        for mode, samples in sorted(self.bot.ttfa_samples.items()):
+            report(f"dequeue -> first audio ({mode})", list(samples))
+        report("gap between tracks", self.gaps)
+        reads = [t for ctx in contexts for t in ctx.voice_client.read_time]
+        report("source.read() per frame", reads, unit="µs", scale=1_000_000)
+        print(
+            f"{'CPU per concurrent stream':<34} {(cpu + children) / max(streamed, 1e-9) * 100:>8.2f}% of a core "
+            f"(bot {cpu / max(streamed, 1e-9) * 100:.2f}%, FFmpeg {children / max(streamed, 1e-9) * 100:.2f}%)"
+        )
+        print(f"{'audio streamed':<34} {streamed:>8.1f} s in {wall:.1f} s wall, {self.track_ends} tracks ended")
+
+    async def run_downloads(self, count, first_track):
+        """download_audio for new tracks all at once, then again from the cache."""
+        print(f"\n📥 download_audio: {count} tracks requested at once")
+        print("-" * 40)
+        urls = [video_url(index) for index in range(first_track, first_track + count)]
+        tier = self.bot.DEFAULT_QUALITY
+
+        async def timed(url, guild_id):
+            started = time.perf_counter()
+            path, _title = await self.bot.download_audio(url, tier, guild_id)
+            return time.perf_counter() - started, path
+
+        cold = await asyncio.gather(*(timed(url, 2000 + i % 4) for i, url in enumerate(urls)))
+        report("cold (download + encode)", [seconds for seconds, _path in cold])
+        failed = sum(1 for _seconds, path in cold if not path)
+        if failed:
+            print(f"⚠️ {failed} downloads failed")
+        warm = await asyncio.gather(*(timed(url, 2000) for url in urls))
+        report("warm (cache hit)", [seconds for seconds, _path in warm])
+
+    def run_cache_lookups(self, count, first_track, lookups):
+        """Synchronous audio_cache.lookup cost for hits and misses."""
+        print(f"\n💾 audio_cache.lookup: {lookups} lookups")
+        print("-" * 40)
+        cache = self.bot.audio_cache
+        keys = [cache.key_from_url(video_url(index)) for index in range(first_track, first_track + count)]
+        tier = self.bot.DEFAULT_QUALITY
+        for name, lookup_keys in (("hit", keys), ("miss", [key + "x" for key in keys])):
+            samples = []
+            for i in range(lookups):
+                started = time.perf_counter()
+                cache.lookup(lookup_keys[i % len(lookup_keys)], tier)
+                samples.append(time.perf_counter() - started)
+            report(name, samples, unit="µs", scale=1_000_000)
+
+
+def _cpu_seconds(now, before):
+    return (now.ru_utime - before.ru_utime) + (now.ru_stime - before.ru_stime)
+
+
+def load_bot(workdir, args):
+    """Import turboBot inside the scratch directory with the fake extractor."""
+    os.chdir(workdir)
+    # The bot reads its settings at import time
+    os.environ.setdefault("DISCORD_BOT_TOKEN", "bench")
+    yt_dlp.YoutubeDL = FakeYoutubeDL
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import turboBot
+    return turboBot
+
+
+async def main(args):
+    if shutil.which("ffmpeg") is None:
+        sys.exit("ffmpeg is required on PATH")
+
+    workdir = tempfile.mkdtemp(prefix="bench_music_")
+    server = TrackServer(os.path.join(workdir, "tracks"), args.seconds)
+    os.makedirs(server.directory)
+    server.start()
+    FakeYoutubeDL.server = server
+    FakeYoutubeDL.latency = args.latency
+    FakeYoutubeDL.throughput = args.throughput * 1024 * 1024
+
+    try:
+        turboBot = load_bot(workdir, args)
+        # Normally set when the bot logs in
+        turboBot.bot.loop = asyncio.get_running_loop()
+        bench = Bench(turboBot)
+
+        print("🧪 Music pipeline benchmark")
+        print("-" * 40)
+        print(
+            f"extractor latency {args.latency * 1000:.0f} ms, download {args.throughput} MB/s, "
+            f"progressive={turboBot.PROGRESSIVE_PLAYBACK}, shared={turboBot.SHARED_STREAMS}, "
+            f"gapless={turboBot.GAPLESS_PLAYBACK}, download slots={turboBot.download_scheduler.DOWNLOAD_SLOTS}"
+        )
+
+        tracks = args.guilds * args.tracks
+        await bench.run_playback("cold cache", args.guilds, args.tracks, args.seconds, 0)
+        await bench.run_playback("warm cache", args.guilds, args.tracks, args.seconds, 0)
+        await bench.run_downloads(args.downloads, tracks)
+        bench.run_cache_lookups(args.downloads, tracks, args.lookups)
+
+        calls = ", ".join(f"{count} {name}" for name, count in sorted(FakeYoutubeDL.calls.items()))
+        print(f"\nfake extractor calls: {calls}")
+    finally:
+        server.close()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+        else:
+            print(f"Kept scratch directory {workdir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the music pipeline without Discord or YouTube")
+    parser.add_argument("--guilds", type=int, default=4, help="guilds playing at the same time")
+    parser.add_argument("--tracks", type=int, default=3, help="tracks queued per guild")
+    parser.add_argument("--seconds", type=int, default=8, help="length of each track")
+    parser.add_argument("--latency", type=float, default=0.3, help="fake extractor round trip in seconds")
+    parser.add_argument("--throughput", type=float, default=2.0, help="fake download speed in MB/s")
+    parser.add_argument("--downloads", type=int, default=8, help="tracks for the download_audio run")
+    parser.add_argument("--lookups", type=int, default=20000, help="iterations for the cache lookup run")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,107 @@
+import array
+import os
+import sys
+import time
+
+import discord
+import numpy as np
+
+from audio_sources import LiveGainSource
+
+
+# One 20 ms frame of 48 kHz stereo 16-bit PCM, as Discord reads it
+FRAME = os.urandom(3840)
+FRAMES_PER_SECOND = 50
+
+
+class RepeatSource(discord.AudioSource):
+    """Endless source that returns the same PCM frame."""
+
+    def read(self):
+        return FRAME
+
+
+def python_gain(data, gain):
+    """Per-sample gain in plain Python, for reference."""
+    samples = array.array("h", data)
+    for i, sample in enumerate(samples):
+        samples[i] = max(-32768, min(32767, int(sample * gain)))
+    return samples.tobytes()
+
+
+class PythonGainSource(discord.AudioSource):
+    def __init__(self, original, gain):
+        self.original = original
+        self.gain = gain
+
+    def read(self):
+        return python_gain(self.original.read(), self.gain)
+
+
+class LUTGainSource(discord.AudioSource):
+    """Gain through a 65536-entry lookup table indexed by each sample."""
+
+    def __init__(self, original, gain):
+        self.original = original
+        samples = np.arange(-32768, 32768, dtype=np.float32) * gain
+        table = np.clip(samples, -32768, 32767).astype(np.int16)
+        # Index by the sample's unsigned bit pattern: 0..32767, then -32768..-1
+        self.table = np.roll(table, -32768)
+
+    def read(self):
+        samples = np.frombuffer(self.original.read(), dtype=np.uint16)
+        return self.table[samples].tobytes()
+
+
+class NumpyGainSource(discord.AudioSource):
+    """Vectorized multiply and clip in numpy."""
+
+    def __init__(self, original, gain):
+        self.original = original
+        self.gain = np.float32(gain)
+
+    def read(self):
+        samples = np.frombuffer(self.original.read(), dtype=np.int16) * self.gain
+        return np.clip(samples, -32768, 32767).astype(np.int16).tobytes()
+
+
+def bench(name, source, frames):
+    """Read frames from a source and report frames per CPU-second."""
+    started = time.process_time()
+    for _ in range(frames):
+        source.read()
+    elapsed = max(time.process_time() - started, 1e-9)
+    per_core = frames / elapsed
+    print(
+        f"{name:<36} {per_core:>12,.0f} frames/s per core "
+        f"({per_core / FRAMES_PER_SECOND:,.0f} concurrent streams)"
+    )
+
+
+def main():
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+
+    print("🧪 Volume stage microbenchmark")
+    print("-" * 40)
+    print(f"{frames} frames of {len(FRAME)} bytes each\n")
+
+    bench("source only (no volume stage)", RepeatSource(), frames)
+
+    unity = LiveGainSource(RepeatSource())
+    bench("LiveGainSource at unity", unity, frames)
+
+    scaled = LiveGainSource(RepeatSource())
+    scaled.set_volume(0.8)
+    bench("LiveGainSource at 0.8 (audioop)", scaled, frames)
+
+    bench("PCMVolumeTransformer at 1.0", discord.PCMVolumeTransformer(RepeatSource(), 1.0), frames)
+    bench("PCMVolumeTransformer at 0.8", discord.PCMVolumeTransformer(RepeatSource(), 0.8), frames)
+    bench("numpy LUT gain at 0.8", LUTGainSource(RepeatSource(), 0.8), frames)
+    bench("numpy vectorized gain at 0.8", NumpyGainSource(RepeatSource(), 0.8), frames)
+
+    # Pure Python is orders of magnitude slower, so run it for fewer frames
+    bench("per-sample Python gain at 0.8", PythonGainSource(RepeatSource(), 0.8), max(frames // 100, 10))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict, defaultdict, deque
+from contextlib import asynccontextmanager
+
+
+# -------------------------
+# DOWNLOAD / TRANSCODE SCHEDULER
+# -------------------------
+# Full downloads (and the cache encode that follows) take a slot from one
+# global pool. Waiting jobs are granted by priority first, then round-robin
+# across guilds, so one guild queuing dozens of tracks cannot starve another
+# guild's single song.
+
+# One slot by default leaves the other yt-dlp worker free for the quick
+# extractions that start streams and searches
+DOWNLOAD_SLOTS = int(os.getenv("MUSIC_DOWNLOAD_SLOTS", "1"))
+
+# Lower value wins: a track someone is waiting to hear, then the head of each
+# guild's queue, then deeper prefetch
+PLAY = 0
+NEXT = 1
+PREFETCH = 2
+PRIORITY_NAMES = {PLAY: "play", NEXT: "next", PREFETCH: "prefetch"}
+
+_active = 0
+# priority -> guild_id -> deque of waiting tickets; guild order is the rotation
+_waiting = {priority: OrderedDict() for priority in PRIORITY_NAMES}
+# Waiting tickets by job key so a queued prefetch can be promoted
+_by_key = {}
+
+_stats = defaultdict(lambda: {"granted": 0, "wait_total": 0.0, "wait_max": 0.0})
+
+
+def _next_ticket():
+    """Pop the next ticket: best priority first, round-robin across guilds."""
+    for priority in sorted(_waiting):
+        guilds = _waiting[priority]
+        while guilds:
+            guild_id, tickets = next(iter(guilds.items()))
+            ticket = tickets.popleft()
+            # Move this guild to the back of the rotation
+            del guilds[guild_id]
+            if tickets:
+                guilds[guild_id] = tickets
+            if ticket["future"].cancelled():
+                continue
+            return ticket
+    return None
+
+
+def _dispatch():
+    global _active
+    while _active < DOWNLOAD_SLOTS:
+        ticket = _next_ticket()
+        if ticket is None:
+            break
+        if _by_key.get(ticket["key"]) is ticket:
+            del _by_key[ticket["key"]]
+        _active += 1
+        wait = time.monotonic() - ticket["queued_at"]
+        stats = _stats[ticket["priority"]]
+        stats["granted"] += 1
+        stats["wait_total"] += wait
+        stats["wait_max"] = max(stats["wait_max"], wait)
+        ticket["future"].set_result(None)
+
+
+def _release():
+    global _active
+    _active -= 1
+    _dispatch()
+
+
+@asynccontextmanager
+async def slot(guild_id, priority=PREFETCH, key=None):
+    """Hold one download slot for the body of the block."""
+    ticket = {
+        "future": asyncio.get_running_loop().create_future(),
+        "guild_id": guild_id,
+        "priority": priority,
+        "key": key,
+        "queued_at": time.monotonic(),
+    }
+    _waiting[priority].setdefault(guild_id, deque()).append(ticket)
+    if key is not None:
+        _by_key[key] = ticket
+    _dispatch()
+
+    try:
+        await ticket["future"]
+    except asyncio.CancelledError:
+        if _by_key.get(key) is ticket:
+            del _by_key[key]
+        # The slot may have been granted just before the cancellation landed
+        if ticket["future"].done() and not ticket["future"].cancelled():
+            _release()
+        raise
+
+    try:
+        yield
+    finally:
+        _release()
+
+
+def promote(key, priority):
+    """Raise the priority of a waiting job, e.g. a prefetch that is now playing."""
+    ticket = _by_key.get(key)
+    if ticket is None or ticket["priority"] <= priority:
+        return
+    guilds = _waiting[ticket["priority"]]
+    tickets = guilds.get(ticket["guild_id"])
+    if tickets is None or ticket not in tickets:
+        return
+    tickets.remove(ticket)
+    if not tickets:
+        del guilds[ticket["guild_id"]]
+    ticket["priority"] = priority
+    _waiting[priority].setdefault(ticket["guild_id"], deque()).append(ticket)
+    _dispatch()
+
+
+def get_stats() -> dict:
+    """Snapshot of slot usage, waiting jobs and queue-wait times per priority."""
+    waiting = defaultdict(int)
+    guilds = set()
+    for priority, by_guild in _waiting.items():
+        for guild_id, tickets in by_guild.items():
+            live = sum(1 for ticket in tickets if not ticket["future"].cancelled())
+            waiting[PRIORITY_NAMES[priority]] += live
+            if live:
+                guilds.add(guild_id)
+    priorities = {}
+    for priority, stats in _stats.items():
+        priorities[PRIORITY_NAMES[priority]] = dict(
+            stats, wait_avg=stats["wait_total"] / max(stats["granted"], 1)
+        )
+    return {
+        "slots": DOWNLOAD_SLOTS,
+        "active": _active,
+        "waiting": dict(waiting),
+        "waiting_guilds": len(guilds),
+        "priorities": priorities,
+    }
@@ -1,56 +1,24 @@
 import os
-import sqlite3
-import time
 from typing import List
 
 from langchain_classic.agents.react.agent import create_react_agent
 from langchain_classic.agents.agent import AgentExecutor
 from langchain_community.chat_models import ChatOllama
+from langchain_core.callbacks import BaseCallbackHandler
 from langchain_core.prompts import PromptTemplate
 from langchain.tools import tool
 
 from ddgs import DDGS
 import trafilatura
 
+import agent_cache
+import llm_scheduler
+
 
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://192.168.0.242:11434")
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "gemma3:4b")
 
 
-# -------------------------
-# SIMPLE SQLITE CACHE
-# -------------------------
-
-CACHE_DB = os.getenv("AGENT_CACHE_DB", "agent_cache.db")
-
-def init_cache():
-    conn = sqlite3.connect(CACHE_DB)
-    conn.execute(
-        "CREATE TABLE IF NOT EXISTS cache (query TEXT PRIMARY KEY, answer TEXT, ts REAL)"
-    )
-    conn.commit()
-    conn.close()
-
-def cache_get(query: str):
-    conn = sqlite3.connect(CACHE_DB)
-    cur = conn.cursor()
-    cur.execute("SELECT answer FROM cache WHERE query=?", (query,))
-    row = cur.fetchone()
-    conn.close()
-    return row[0] if row else None
-
-def cache_set(query: str, answer: str):
-    conn = sqlite3.connect(CACHE_DB)
-    conn.execute(
-        "INSERT OR REPLACE INTO cache (query, answer, ts) VALUES (?, ?, ?)",
-        (query, answer, time.time()),
-    )
-    conn.commit()
-    conn.close()
-
-init_cache()
-
-
 # -------------------------
 # TOOLS (without @tool decorator)
 # -------------------------
@@ -137,31 +105,85 @@ def build_agent(mode: str):
     return agent_executor
 
 
+# -------------------------
+# STREAMING FINAL ANSWER
+# -------------------------
+
+class FinalAnswerStream(BaseCallbackHandler):
+    """Pass the text after "Final Answer:" to on_token as the model writes it."""
+
+    MARKER = "Final Answer:"
+
+    def __init__(self, on_token):
+        self.on_token = on_token
+        self.buffer = ""
+        self.streaming = False
+
+    def on_llm_start(self, *args, **kwargs):
+        # Each ReAct step is a new generation; only the last one has the answer
+        self.buffer = ""
+        self.streaming = False
+
+    def on_llm_new_token(self, token: str, **kwargs):
+        if self.streaming:
+            self.on_token(token)
+            return
+        self.buffer += token
+        index = self.buffer.find(self.MARKER)
+        if index != -1:
+            self.streaming = True
+            rest = self.buffer[index + len(self.MARKER):].lstrip()
+            if rest:
+                self.on_token(rest)
+
+
 _agents = {}
 
 import asyncio
 
-async def run_agent(query: str):
-    cached = cache_get(query)
-    if cached:
-        return cached
+async def run_agent(query: str, on_token=None, guild_id=None, user_id=None,
+                    priority=llm_scheduler.INTERACTIVE, on_queued=None):
+    """
+    Answer a query with the ReAct agent.
 
+    on_token, if given, is called from the agent's worker thread with each
+    piece of the final answer as it is generated. The run holds one
+    llm_scheduler slot; guild_id, user_id, priority and on_queued are passed
+    to it, and it raises llm_scheduler.LLMBusy if the request is shed.
+    """
     mode = classify_query(query)
+    cached, query_vector = await agent_cache.lookup(query, mode, guild_id, user_id, priority)
+    if cached:
+        return cached
 
     if mode not in _agents:
         _agents[mode] = build_agent(mode)
 
     agent = _agents[mode]
-
-    # 🔑 run blocking agent in a thread
-    answer = await asyncio.to_thread(
-        agent.invoke,
-        {"input": query}
-    )
+    config = {"callbacks": [FinalAnswerStream(on_token)]} if on_token else None
+
+    # 🔑 run blocking agent in a thread, one Ollama-bound run per slot
+    async with llm_scheduler.slot(guild_id, user_id, priority, on_queued):
+        run = asyncio.ensure_future(asyncio.to_thread(
+            agent.invoke,
+            {"input": query},
+            config,
+        ))
+        try:
+            answer = await asyncio.shield(run)
+        except asyncio.CancelledError:
+            # The thread can't be stopped and keeps calling Ollama, so the
+            # slot is only given back once it has finished
+            while not run.done():
+                try:
+                    await asyncio.wait([run])
+                except asyncio.CancelledError:
+                    pass
+            raise
 
     # AgentExecutor returns dict
     if isinstance(answer, dict):
         answer = answer.get("output", "")
 
-    cache_set(query, answer)
+    await agent_cache.save(query, answer, mode, query_vector)
     return answer
\ No newline at end of file
@@ -0,0 +1,184 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict, defaultdict, deque
+from contextlib import asynccontextmanager
+
+
+# -------------------------
+# LLM REQUEST SCHEDULER
+# -------------------------
+# Every AI request (a whole agent run or Ollama call) takes a slot from one
+# global pool sized for the Ollama host. Waiting requests are granted by
+# priority first, then round-robin across guilds and, within a guild, across
+# users, so a busy lounge can't starve someone's !askollama. When too many
+# requests are already waiting, new ones are turned away with LLMBusy
+# instead of piling up until they time out.
+
+LLM_SLOTS = int(os.getenv("OLLAMA_CONCURRENCY", "1"))
+# Requests allowed to wait at once; lounge chatter gets half of that
+MAX_WAITING = int(os.getenv("OLLAMA_MAX_QUEUE", "6"))
+# A request still waiting after this long is shed rather than left to time out
+MAX_WAIT = float(os.getenv("OLLAMA_MAX_WAIT", "90"))
+# Waiting requests per user; more are turned away
+MAX_WAITING_PER_USER = 1
+
+# Lower value wins: a command someone ran, then lounge conversation
+INTERACTIVE = 0
+CHAT = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", CHAT: "chat"}
+
+
+class LLMBusy(Exception):
+    """Raised when a request is shed instead of queued."""
+
+    def __init__(self, message, waiting):
+        super().__init__(message)
+        self.waiting = waiting
+
+
+_active = 0
+# priority -> guild_id -> user_id -> deque of waiting tickets; dict order is the rotation
+_waiting = {priority: OrderedDict() for priority in PRIORITY_NAMES}
+_waiting_users = defaultdict(int)
+
+_stats = defaultdict(lambda: {"granted": 0, "shed": 0, "wait_total": 0.0, "wait_max": 0.0})
+
+
+def _next_ticket():
+    """Pop the next ticket: best priority first, then round-robin by guild and user."""
+    for priority in sorted(_waiting):
+        guilds = _waiting[priority]
+        while guilds:
+            guild_id, users = next(iter(guilds.items()))
+            user_id, tickets = next(iter(users.items()))
+            ticket = tickets.popleft()
+            # Move this user, then this guild, to the back of the rotation
+            del users[user_id]
+            if tickets:
+                users[user_id] = tickets
+            del guilds[guild_id]
+            if users:
+                guilds[guild_id] = users
+            if ticket["future"].cancelled():
+                continue
+            return ticket
+    return None
+
+
+def _dispatch():
+    global _active
+    while _active < LLM_SLOTS:
+        ticket = _next_ticket()
+        if ticket is None:
+            break
+        _active += 1
+        wait = time.monotonic() - ticket["queued_at"]
+        stats = _stats[ticket["priority"]]
+        stats["granted"] += 1
+        stats["wait_total"] += wait
+        stats["wait_max"] = max(stats["wait_max"], wait)
+        ticket["future"].set_result(None)
+
+
+def _release():
+    global _active
+    _active -= 1
+    _dispatch()
+
+
+def waiting_count(priorities=None) -> int:
+    """Requests waiting at the given priorities (all of them by default)."""
+    count = 0
+    for priority, guilds in _waiting.items():
+        if priorities is not None and priority not in priorities:
+            continue
+        for users in guilds.values():
+            for tickets in users.values():
+                count += sum(1 for ticket in tickets if not ticket["future"].cancelled())
+    return count
+
+
+def has_free_slot() -> bool:
+    """True if a request would be granted a slot right away, without queueing."""
+    return _active < LLM_SLOTS and not waiting_count()
+
+
+def _shed(priority, reason):
+    _stats[priority]["shed"] += 1
+    raise LLMBusy(reason, waiting_count())
+
+
+@asynccontextmanager
+async def slot(guild_id=None, user_id=None, priority=INTERACTIVE, on_queued=None):
+    """
+    Hold one LLM slot for the body of the block.
+
+    If the request has to wait, on_queued(position) is awaited first so the
+    caller can tell the user. Raises LLMBusy if the queue is full, the user
+    already has a request waiting, or the wait exceeds MAX_WAIT.
+    """
+    waiting = waiting_count()
+    limit = MAX_WAITING if priority == INTERACTIVE else MAX_WAITING // 2
+    if waiting and waiting >= limit:
+        _shed(priority, f"{waiting} requests are already waiting")
+    if user_id is not None and _waiting_users.get(user_id, 0) >= MAX_WAITING_PER_USER:
+        _shed(priority, "you already have a request waiting")
+
+    ticket = {
+        "future": asyncio.get_running_loop().create_future(),
+        "priority": priority,
+        "queued_at": time.monotonic(),
+    }
+    _waiting[priority].setdefault(guild_id, OrderedDict()).setdefault(user_id, deque()).append(ticket)
+    _dispatch()
+
+    if not ticket["future"].done():
+        if user_id is not None:
+            _waiting_users[user_id] += 1
+        try:
+            if on_queued is not None:
+                # Everything at this priority or better is served first. A
+                # failed notice (e.g. a deleted status message) must not
+                # abandon the ticket, so the request just keeps waiting.
+                try:
+                    await on_queued(waiting_count(range(priority + 1)))
+                except Exception as exc:
+                    print(f"⚠️ LLM queue notice failed: {exc}")
+            await asyncio.wait_for(asyncio.shield(ticket["future"]), MAX_WAIT)
+        except BaseException as exc:
+            # Whatever ends the wait, never leave the ticket behind: the slot
+            # may have been granted just before we gave up on it
+            if ticket["future"].done() and not ticket["future"].cancelled():
+                _release()
+            else:
+                ticket["future"].cancel()
+            if isinstance(exc, asyncio.TimeoutError):
+                _shed(priority, f"no slot freed up within {MAX_WAIT:.0f}s")
+            raise
+        finally:
+            if user_id is not None:
+                _waiting_users[user_id] -= 1
+                if not _waiting_users[user_id]:
+                    del _waiting_users[user_id]
+
+    try:
+        yield
+    finally:
+        _release()
+
+
+def get_stats() -> dict:
+    """Snapshot of slot usage, waiting requests and queue-wait times per priority."""
+    waiting = {name: waiting_count([priority]) for priority, name in PRIORITY_NAMES.items()}
+    priorities = {}
+    for priority, stats in _stats.items():
+        priorities[PRIORITY_NAMES[priority]] = dict(
+            stats, wait_avg=stats["wait_total"] / max(stats["granted"], 1)
+        )
+    return {
+        "slots": LLM_SLOTS,
+        "active": _active,
+        "waiting": waiting,
+        "priorities": priorities,
+    }
@@ -0,0 +1,75 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from audio_cache import DOWNLOAD_DIR
+
+
+# -------------------------
+# PERSISTENT MUSIC STATE
+# -------------------------
+# Per-guild playback state (voice and text channel, quality, volume, the
+# queue and the current track with its position) is checkpointed to SQLite
+# as one JSON row per guild, so a restart can rejoin and resume where it
+# left off. The playback position changes constantly, so it has its own
+# column and is updated without rewriting the queue. Writes are blocking;
+# call them off the event loop.
+
+STATE_DB = os.path.join(DOWNLOAD_DIR, "music_state.db")
+
+_db = None
+_db_lock = threading.Lock()
+
+
+def init_state():
+    """Open the state database (blocking, idempotent)."""
+    global _db
+    with _db_lock:
+        if _db is not None:
+            return
+        _db = sqlite3.connect(STATE_DB, check_same_thread=False)
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute(
+            "CREATE TABLE IF NOT EXISTS guilds "
+            "(guild_id INTEGER PRIMARY KEY, state TEXT, position REAL, saved_at REAL)"
+        )
+        _db.commit()
+
+
+def save(changes: dict, positions: dict = None):
+    """
+    Write {guild_id: state} and {guild_id: position} in one transaction.
+
+    A state of None deletes the guild's row.
+    """
+    init_state()
+    now = time.time()
+    with _db_lock, _db:
+        for guild_id, state in changes.items():
+            if state is None:
+                _db.execute("DELETE FROM guilds WHERE guild_id=?", (guild_id,))
+            else:
+                _db.execute(
+                    "INSERT OR REPLACE INTO guilds (guild_id, state, position, saved_at) VALUES (?, ?, ?, ?)",
+                    (guild_id, json.dumps(state), (positions or {}).get(guild_id), now),
+                )
+        for guild_id, position in (positions or {}).items():
+            _db.execute(
+                "UPDATE guilds SET position=?, saved_at=? WHERE guild_id=?", (position, now, guild_id)
+            )
+
+
+def load_all() -> dict:
+    """Return {guild_id: state} for every saved guild, with position and saved_at added."""
+    init_state()
+    with _db_lock:
+        rows = _db.execute("SELECT guild_id, state, position, saved_at FROM guilds").fetchall()
+    states = {}
+    for guild_id, state, position, saved_at in rows:
+        try:
+            states[guild_id] = dict(json.loads(state), position=position or 0.0, saved_at=saved_at)
+        except ValueError:
+            print(f"Skipping unreadable music state for guild {guild_id}")
+    return states
@@ -0,0 +1,115 @@
+import asyncio
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+
+from aiohttp import web
+
+# The cache reads its settings at import time
+DB_DIR = tempfile.mkdtemp(prefix="agent_cache_test_")
+os.environ["AGENT_CACHE_DB"] = os.path.join(DB_DIR, "agent_cache.db")
+os.environ["OLLAMA_BASE_URL"] = "http://127.0.0.1:11435"
+os.environ["AGENT_SEMANTIC_CACHE"] = "true"
+
+import agent_cache
+
+
+EMBED_DIMS = 256
+
+
+def fake_embedding(text):
+    """Bag-of-words vector: texts sharing most words score a high cosine."""
+    vector = [0.0] * EMBED_DIMS
+    for word in re.findall(r"\w+", text.lower()):
+        digest = hashlib.md5(word.encode()).digest()
+        vector[int.from_bytes(digest[:4], "little") % EMBED_DIMS] += 1.0
+    return vector
+
+
+async def start_fake_ollama():
+    """Serve /api/embed like Ollama does, counting calls."""
+    calls = {"embed": 0}
+
+    async def embed(request):
+        calls["embed"] += 1
+        data = await request.json()
+        texts = data["input"] if isinstance(data["input"], list) else [data["input"]]
+        return web.json_response({"model": data["model"], "embeddings": [fake_embedding(t) for t in texts]})
+
+    app = web.Application()
+    app.router.add_post("/api/embed", embed)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 11435).start()
+    return runner, calls
+
+
+def check(name, ok):
+    print(f"{'✅' if ok else '❌'} {name}")
+    return ok
+
+
+async def main():
+    print("🧪 Agent answer cache test")
+    print("-" * 40)
+    runner, calls = await start_fake_ollama()
+    results = []
+    try:
+        results.append(check(
+            "normalization folds case, punctuation and contractions",
+            agent_cache.normalize_query("What's RL ?") == agent_cache.normalize_query("what is rl")
+            == agent_cache.normalize_query("  What is RL?")
+        ))
+        results.append(check(
+            "contractions only fold as whole words",
+            agent_cache.normalize_query("which shows are on") == "which shows are on"
+            and agent_cache.normalize_query("Is WhatsApp down?") == "is whatsapp down"
+            and agent_cache.normalize_query("whose car") == "whose car"
+            and agent_cache.normalize_query("don't stop") == "do not stop"
+            and agent_cache.normalize_query("which shows") != agent_cache.normalize_query("which show is")
+        ))
+
+        answer, vector = await agent_cache.lookup("What is RL?", "theory")
+        results.append(check("first lookup misses and returns its embedding", answer is None and vector is not None))
+        await agent_cache.save("What is RL?", "Reinforcement learning.", "theory", vector)
+
+        answer, _ = await agent_cache.lookup("what's rl", "theory")
+        results.append(check("normalized variant hits without a model call", answer == "Reinforcement learning."))
+
+        question = "what is reinforcement learning in machine learning"
+        answer, vector = await agent_cache.lookup(question, "theory")
+        await agent_cache.save(question, "RL answer.", "theory", vector)
+        answer, _ = await agent_cache.lookup(question + " exactly", "theory")
+        results.append(check("near-duplicate question is a semantic hit", answer == "RL answer."))
+
+        answer, _ = await agent_cache.lookup(question + " exactly", "news")
+        results.append(check("semantic hits never cross query modes", answer is None))
+
+        answer, _ = await agent_cache.lookup("how do transformers use attention", "theory")
+        results.append(check("unrelated question misses", answer is None))
+
+        # An answer only served from memory still counts as recently used
+        agent_cache.MAX_ROWS = 2
+        await agent_cache.save("hot question", "Hot.", "theory")
+        await agent_cache.save("cold question", "Cold.", "theory")
+        await asyncio.sleep(0.01)
+        await agent_cache.lookup("hot question", "theory")
+        await agent_cache.save("new question", "New.", "theory")
+        kept = {row[0] for row in agent_cache._db.execute("SELECT query FROM cache")}
+        results.append(check("L1 hits protect an answer from LRU eviction", kept == {"hot question", "new question"}))
+
+        stats = agent_cache.cache_stats()
+        print(f"\nstats: {stats}")
+        print(f"fake embedding calls: {calls['embed']}")
+    finally:
+        await agent_cache.close()
+        await runner.cleanup()
+        shutil.rmtree(DB_DIR, ignore_errors=True)
+
+    print(f"\n{sum(results)}/{len(results)} checks passed")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
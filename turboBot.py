@@ -2,23 +2,48 @@ import json
 import asyncio
 import aiohttp
 import os
-import yt_dlp as youtube_dl
 from datetime import datetime, timedelta
 from collections import defaultdict, deque
-import shutil
+from itertools import islice
+import tempfile
 import time
+from urllib.parse import urlparse, parse_qs
 import discord
 from discord.ext import commands, tasks
 from discord.utils import escape_mentions
 from dotenv import load_dotenv
-from langchain_agent import run_agent
+# Local modules read their settings from the environment at import time
 load_dotenv()
+from langchain_agent import run_agent
+import audio_cache
+import ytdl_service
+import download_scheduler
+import llm_scheduler
+import agent_cache
+import music_state
+from audio_sources import (
+    CachingFFmpegPCMAudio, LiveGainSource, OggOpusFileAudio, OpusDecodeSource,
+    SharedOpusStream, SharedStreamAudio, TimedSource,
+)
+from audio_cache import DOWNLOAD_DIR
 AGENT_DEBUG = os.getenv("AGENT_DEBUG", "false").lower() in ("1", "true", "yes")
 
 TOKEN = os.getenv("DISCORD_BOT_TOKEN")  # Secure token handling
 PREFIX = "!"
 intents = discord.Intents.all()
-bot = commands.Bot(command_prefix=commands.when_mentioned_or(PREFIX), intents=intents)
+
+class TurboBot(commands.Bot):
+    async def setup_hook(self):
+        # Embedding lookups share the pooled connections to Ollama
+        agent_cache.use_http_session(get_http_session)
+
+    async def close(self):
+        # Let pooled HTTP connections close cleanly before the loop stops
+        await close_http_session()
+        await agent_cache.close()
+        await super().close()
+
+bot = TurboBot(command_prefix=commands.when_mentioned_or(PREFIX), intents=intents)
 
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://192.168.0.242:11434")
 DEFAULT_OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "gemma3:4b")
@@ -26,6 +51,13 @@ OLLAMA_ALLOWED_ROLE = "AI"
 OLLAMA_REQUIRE_MANAGE_MESSAGES = os.getenv("OLLAMA_REQUIRE_MANAGE_MESSAGES", "true").lower() not in ("false", "0", "off", "no")
 OLLAMA_MAX_PROMPT_LENGTH = int(os.getenv("OLLAMA_MAX_PROMPT_LENGTH", "3500"))
 OLLAMA_MAX_RESPONSE_LENGTH = int(os.getenv("OLLAMA_MAX_RESPONSE_LENGTH", "3500"))
+OLLAMA_TIMEOUT = aiohttp.ClientTimeout(total=120)
+# Streams may run long; give up only if Ollama goes quiet
+OLLAMA_STREAM_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=60)
+# Discord allows about 5 edits per 5 seconds per channel
+STREAM_EDIT_INTERVAL = 1.2
+STREAM_CURSOR = " ▌"
+SCRAPE_TIMEOUT = aiohttp.ClientTimeout(total=15)
 AI_CHAT_CHANNEL_NAMES = {"ai-lounge"}
 AI_CHAT_HISTORY_LENGTH = 6
 AI_SYSTEM_PROMPT = (
@@ -36,14 +68,7 @@ AI_SYSTEM_PROMPT = (
     "If you are unsure about something, say so honestly and suggest practical next steps."
 )
 
-# Create a downloads directory if it doesn't exist
-DOWNLOAD_DIR = "music_downloads"
-if not os.path.exists(DOWNLOAD_DIR):
-    os.makedirs(DOWNLOAD_DIR)
-
-# File cleanup settings
-MAX_CACHE_SIZE_MB = 500  # Maximum size for the downloads folder (500 MB)
-MAX_FILE_AGE_DAYS = 7    # Files older than this will be deleted
+# File cleanup settings (size and age limits live in audio_cache)
 CLEANUP_INTERVAL = 60    # Check for cleanup every 60 minutes
 
 # Global variable to store the rules message ID
@@ -56,6 +81,8 @@ DEFAULT_QUALITY = "medium"
 
 # Store information about currently playing songs
 current_songs = {}
+# Text channel each guild's music messages go to, so a restart can reuse it
+music_channels = {}
 
 # Track active reminder tasks per user and guild
 reminder_tasks = {}
@@ -63,6 +90,42 @@ reminder_tasks = {}
 # Conversation history per AI lounge channel
 ai_channel_history = defaultdict(lambda: deque(maxlen=AI_CHAT_HISTORY_LENGTH * 2))
 
+# Ollama KV context per AI lounge channel, so each turn only sends the new
+# message instead of re-rendering (and re-prefilling) the whole conversation.
+# A session only lives as long as the history it was built from: once the
+# history would be trimmed (OLLAMA_MAX_PROMPT_LENGTH) or its deque would drop
+# old turns, the session is rebuilt from the trimmed history.
+ai_sessions = {}  # channel_id -> {'context': [...], 'model': str}
+# Prompt prefill per lounge turn, "reused" (context kept) or "fresh": (seconds, tokens)
+ai_prefill_samples = defaultdict(lambda: deque(maxlen=100))
+
+# One pooled HTTP session for the bot's lifetime (Ollama and page scraping),
+# so repeated calls reuse keep-alive connections and cached DNS lookups
+# instead of opening a new TCP connection per request.
+HTTP_POOL_LIMIT = 20          # open connections in total
+HTTP_POOL_PER_HOST = 4        # per host, so one slow site can't take them all
+HTTP_DNS_CACHE_TTL = 300      # seconds
+http_session = None
+
+async def get_http_session():
+    """Return the shared aiohttp session, creating it on first use"""
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_PER_HOST,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+            keepalive_timeout=60,
+        )
+        http_session = aiohttp.ClientSession(connector=connector)
+    return http_session
+
+async def close_http_session():
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
 def chunk_message(text, limit=1900):
     """Split long text into Discord-safe chunks."""
     if not text:
@@ -105,6 +168,67 @@ def sanitize_for_discord(text):
     return safe or "(No response provided.)"
 
 
+class ProgressiveReply:
+    """A reply shown while it is generated, editing messages in place"""
+
+    def __init__(self, channel, message=None):
+        self.channel = channel
+        self.messages = [message] if message else []
+        self.shown = [None] * len(self.messages)
+        self.text = ""
+        self.changed = asyncio.Event()
+
+    def feed(self, token):
+        self.text += token
+        self.changed.set()
+
+    async def render(self, text, cursor=""):
+        """Show text, rolling over into new messages past the length limit"""
+        chunks = chunk_message(sanitize_for_discord(text))
+        chunks[-1] += cursor
+        for index, chunk in enumerate(chunks):
+            if index < len(self.messages):
+                if self.shown[index] != chunk:
+                    await self.messages[index].edit(content=chunk)
+            else:
+                self.messages.append(await self.channel.send(chunk))
+                self.shown.append(None)
+            self.shown[index] = chunk
+        # The final text can be shorter than what was streamed
+        while len(self.messages) > len(chunks):
+            await self.messages.pop().delete()
+            self.shown.pop()
+
+async def stream_reply(channel, generate, message=None):
+    """
+    Run generate(on_token) and show its output as it arrives.
+
+    on_token may be called from any thread. Partial text goes into message
+    (or a new message once the first token arrives), edited at most once
+    per STREAM_EDIT_INTERVAL. Returns (reply, final_text) with the final
+    text not yet rendered, so the caller can tidy it up first.
+    """
+    loop = asyncio.get_running_loop()
+    reply = ProgressiveReply(channel, message)
+    task = asyncio.ensure_future(generate(lambda token: loop.call_soon_threadsafe(reply.feed, token)))
+    try:
+        while not task.done():
+            waiter = asyncio.ensure_future(reply.changed.wait())
+            await asyncio.wait({task, waiter}, return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+            if task.done():
+                break
+            reply.changed.clear()
+            if not reply.text.strip():
+                continue
+            await reply.render(reply.text, STREAM_CURSOR)
+            # Tokens arriving in the meantime go out with the next edit
+            await asyncio.wait({task}, timeout=STREAM_EDIT_INTERVAL)
+    finally:
+        if not task.done():
+            task.cancel()
+    return reply, task.result()
+
 def describe_user_message(message):
     """Summarize a Discord message for context when sending to the LLM."""
     content = (message.content or "").strip()
@@ -122,122 +246,174 @@ def describe_user_message(message):
     return " ".join(parts).strip()
 
 
+def render_ai_chat_prompt(items):
+    """Render conversation turns into the lounge prompt, without trimming."""
+    conversation_lines = []
+    for role, content in items:
+        label = "User" if role == "user" else "Assistant"
+        conversation_lines.append(f"{label}: {content}")
+    conversation_body = "\n".join(conversation_lines) if conversation_lines else "User: Hello!"
+    return f"{AI_SYSTEM_PROMPT}\n\nConversation so far:\n{conversation_body}\nAssistant:"
+
 def build_ai_chat_prompt(history):
     """Create an instructional prompt for the LLM using the stored conversation."""
-
-    def render_prompt(items):
-        conversation_lines = []
-        for role, content in items:
-            label = "User" if role == "user" else "Assistant"
-            conversation_lines.append(f"{label}: {content}")
-        conversation_body = "\n".join(conversation_lines) if conversation_lines else "User: Hello!"
-        return f"{AI_SYSTEM_PROMPT}\n\nConversation so far:\n{conversation_body}\nAssistant:"
-
     trimmed_history = list(history)
-    prompt = render_prompt(trimmed_history)
+    prompt = render_ai_chat_prompt(trimmed_history)
 
     while len(prompt) > OLLAMA_MAX_PROMPT_LENGTH and len(trimmed_history) > 2:
         trimmed_history = trimmed_history[2:]
-        prompt = render_prompt(trimmed_history)
+        prompt = render_ai_chat_prompt(trimmed_history)
 
     if len(prompt) > OLLAMA_MAX_PROMPT_LENGTH and trimmed_history:
         role, content = trimmed_history[-1]
         trimmed_history[-1] = (role, content[-(OLLAMA_MAX_PROMPT_LENGTH // 2):])
-        prompt = render_prompt(trimmed_history)
+        prompt = render_ai_chat_prompt(trimmed_history)
 
     history.clear()
     history.extend(trimmed_history)
     return prompt
 
-# Function to clean up old downloaded files
-def cleanup_old_files():
-    """Delete old downloaded files to save disk space"""
-    # Skip if directory doesn't exist
-    if not os.path.exists(DOWNLOAD_DIR):
-        return
-        
-    try:
-        # Get all files with their last modified time
-        files = []
-        total_size = 0
-        
-        for filename in os.listdir(DOWNLOAD_DIR):
-            file_path = os.path.join(DOWNLOAD_DIR, filename)
-            if os.path.isfile(file_path):
-                # Get file stats
-                file_size = os.path.getsize(file_path)
-                mod_time = os.path.getmtime(file_path)
-                
-                # Skip files that are currently being played
-                if any(song.get('file') == file_path for song in current_songs.values()):
-                    continue
-                    
-                files.append((file_path, mod_time, file_size))
-                total_size += file_size
-        
-        # Sort files by modification time (oldest first)
-        files.sort(key=lambda x: x[1])
-        
-        # Remove files older than MAX_FILE_AGE_DAYS
-        cutoff_time = time.time() - (MAX_FILE_AGE_DAYS * 86400)
-        for file_path, mod_time, _ in files[:]:
-            if mod_time < cutoff_time:
-                try:
-                    os.remove(file_path)
-                    files.remove((file_path, mod_time, _))
-                    print(f"Deleted old file: {file_path}")
-                except:
-                    pass
-        
-        # If we're still over the size limit, delete oldest files until we're under the limit
-        max_size_bytes = MAX_CACHE_SIZE_MB * 1024 * 1024
-        if total_size > max_size_bytes:
-            for file_path, _, file_size in files:
-                if total_size <= max_size_bytes:
-                    break
-                try:
-                    os.remove(file_path)
-                    total_size -= file_size
-                    print(f"Deleted file due to cache size limit: {file_path}")
-                except:
-                    pass
-    except Exception as e:
-        print(f"Error during cleanup: {e}")
+def next_ai_turn(channel_id, history, user_turn):
+    """
+    Record the user's turn and return (prompt, session) for the model.
+
+    With a live session the prompt is just the new turn and the session's
+    context carries the rest. When the history is about to lose turns, either
+    to its deque's maxlen or to build_ai_chat_prompt's length trim, the
+    session would remember what the history forgot, so it is dropped and the
+    trimmed history is rendered in full, starting a new one.
+    """
+    # This turn and its reply push the oldest turns out of a full deque
+    overflows = len(history) + 2 > history.maxlen
+    history.append(("user", user_turn))
+    session = ai_sessions.get(channel_id)
+    if (
+        session and session['model'] == DEFAULT_OLLAMA_MODEL and not overflows
+        and len(render_ai_chat_prompt(history)) <= OLLAMA_MAX_PROMPT_LENGTH
+    ):
+        return user_turn, session
+    ai_sessions.pop(channel_id, None)
+    if overflows or len(render_ai_chat_prompt(history)) > OLLAMA_MAX_PROMPT_LENGTH:
+        # Trim to half of both limits, so the new session gets a run of cheap
+        # turns instead of being rebuilt again on the very next message
+        while len(history) > 2 and (
+            len(history) > history.maxlen // 2
+            or len(render_ai_chat_prompt(history)) > OLLAMA_MAX_PROMPT_LENGTH // 2
+        ):
+            history.popleft()
+            history.popleft()
+    return build_ai_chat_prompt(history), None
+
+def record_prefill(channel_id, kind, final):
+    """Record how long Ollama spent on the prompt of a lounge turn"""
+    seconds = (final.get('prompt_eval_duration') or 0) / 1e9
+    tokens = final.get('prompt_eval_count') or 0
+    ai_prefill_samples[kind].append((seconds, tokens))
+    print(f"Lounge prefill in channel {channel_id}: {tokens} tokens in {seconds * 1000:.0f} ms ({kind})")
 
 @tasks.loop(minutes=CLEANUP_INTERVAL)
 async def cleanup_task():
-    """Background task to clean up old files"""
-    cleanup_old_files()
+    """Background task to expire old files and persist cache access stats"""
+    await asyncio.to_thread(audio_cache.maintain)
 
 @bot.event
 async def on_ready():
+    global music_state_restored
     print(f"{bot.user} is online and ready!")
-    cleanup_task.start()
+    await get_http_session()
+    # Loads the cache index (and reconciles it with disk) once per process
+    await asyncio.to_thread(audio_cache.init_index)
+    if not cleanup_task.is_running():
+        cleanup_task.start()
+    # on_ready fires again after reconnects; only resume once per process
+    if not music_state_restored:
+        music_state_restored = True
+        bot.loop.create_task(restore_music_state())
 
 @bot.command()
 @commands.has_permissions(administrator=True)
 async def cleanup(ctx):
     """Manually trigger audio cache cleanup"""
     await ctx.send("🧹 Cleaning up audio cache...")
-    cleanup_old_files()
+    await asyncio.to_thread(audio_cache.maintain)
     
-    # Calculate current cache size
-    total_size = sum(os.path.getsize(os.path.join(DOWNLOAD_DIR, f)) 
-                     for f in os.listdir(DOWNLOAD_DIR) 
-                     if os.path.isfile(os.path.join(DOWNLOAD_DIR, f)))
-    
-    total_size_mb = total_size / (1024 * 1024)
-    await ctx.send(f"✅ Cleanup complete! Current cache size: {total_size_mb:.2f} MB")
+    # Current cache size comes from the index, not a directory walk
+    stats = audio_cache.cache_stats()
+    total_size_mb = stats['total_bytes'] / (1024 * 1024)
+    await ctx.send(
+        f"✅ Cleanup complete! Current cache size: {total_size_mb:.2f} MB "
+        f"of {audio_cache.MAX_CACHE_SIZE_MB} MB ({stats['entries']} tracks)"
+    )
 
-# Function to get FFmpeg options based on quality setting
-def get_ffmpeg_options(guild_id):
-    quality = audio_quality_settings.get(guild_id, DEFAULT_QUALITY)
-    
-    # Simple options that prioritize stability over quality
+def get_quality(guild_id):
+    """Return the guild's quality tier (a key of audio_cache.QUALITY_TIERS)"""
+    return audio_quality_settings.get(guild_id, DEFAULT_QUALITY)
+
+# Function to get FFmpeg options for cached files or live streams
+def get_ffmpeg_options(guild_id, stream=False):
+    # The guild's volume is applied by FFmpeg's volume filter, outside Python.
+    # Cached files already carry their gain; live streams get the cache gain
+    # here too so both sound the same at a given volume
+    gain = ffmpeg_gain(guild_id)
+    if stream:
+        return {
+            'before_options': '-reconnect 1 -reconnect_streamed 1',
+            'options': f'-vn -af "volume={audio_cache.CACHE_GAIN * gain:.3f}"'
+        }
     return {
-        'options': '-vn -af "volume=0.8"'
+        'options': '-vn' if gain == 1.0 else f'-vn -af "volume={gain:.3f}"'
     }
 
+# Per-guild playback volume in percent. Cached audio is loudness-normalized
+# for DEFAULT_VOLUME, so at that volume it can be sent to Discord untouched.
+DEFAULT_VOLUME = 50
+guild_volumes = {}
+
+def playback_gain(guild_id):
+    """Gain to apply on top of the cached audio level for a guild"""
+    return guild_volumes.get(guild_id, DEFAULT_VOLUME) / DEFAULT_VOLUME
+
+def ffmpeg_gain(guild_id):
+    """Gain baked into a new FFmpeg source; muting is left to the live stage"""
+    return playback_gain(guild_id) or 1.0
+
+def open_cached_source(guild_id, file_path, start=0.0):
+    """Build the cheapest source for a cached file at the guild's volume"""
+    if playback_gain(guild_id) == 1.0 and file_path.endswith(f".{audio_cache.AUDIO_EXT}"):
+        # Opus passthrough: no FFmpeg, no decode, no re-encode
+        return OggOpusFileAudio(file_path, start=start)
+    options = get_ffmpeg_options(guild_id)
+    if start:
+        options['before_options'] = f"-ss {start:.2f}"
+    return discord.FFmpegPCMAudio(file_path, **options)
+
+def wrap_source(guild_id, timer):
+    """
+    Give a just-opened PCM source a live volume stage; Opus sources pass through.
+
+    FFmpeg already applied the guild's volume, so the stage starts at unity.
+    """
+    if timer.is_opus():
+        return timer
+    source = LiveGainSource(timer, applied=ffmpeg_gain(guild_id))
+    source.set_volume(playback_gain(guild_id))
+    return source
+
+def swap_source(voice_client, guild_id, source):
+    """
+    Replace the playing source in place, keeping the track and its after callback.
+
+    discord.py only creates the Opus encoder in play() when the first source
+    is PCM, so a connection that has only played passthrough tracks has none;
+    create it before a PCM source takes over or the next frame kills the track.
+    It uses the guild's tier bitrate, as play_source does.
+    """
+    if not source.is_opus() and voice_client.encoder is discord.utils.MISSING:
+        voice_client.encoder = discord.opus.Encoder(
+            bitrate=audio_cache.QUALITY_TIERS[get_quality(guild_id)]['bitrate']
+        )
+    voice_client.source = source
+
 @bot.command()
 async def quality(ctx, setting=None):
     """Set audio quality (low, medium, high) or show current setting"""
@@ -249,12 +425,19 @@ async def quality(ctx, setting=None):
         return
         
     setting = setting.lower()
-    if setting not in ["low", "medium", "high"]:
+    if setting not in audio_cache.QUALITY_TIERS:
         await ctx.send("Invalid quality setting. Use 'low', 'medium', or 'high'")
         return
         
     audio_quality_settings[guild_id] = setting
-    await ctx.send(f"Audio quality set to: **{setting}**")
+    request_checkpoint()
+    bitrate = audio_cache.QUALITY_TIERS[setting]['bitrate']
+    await ctx.send(f"Audio quality set to: **{setting}** ({bitrate} kbps)")
+
+    # Upcoming downloads should fetch the new tier
+    if guild_id in prefetch_tasks:
+        cancel_prefetch(guild_id)
+        schedule_prefetch(guild_id)
     
     if ctx.voice_client and ctx.voice_client.is_playing():
         await ctx.send("This will take effect on the next song.")
@@ -279,7 +462,235 @@ async def clear(ctx, amount: int):
     await ctx.send(f"Deleted {amount} messages.", delete_after=3)
 
 # Music Queue System (Multi-Guild Support)
-music_queues = {}
+music_queues = defaultdict(deque)
+
+# Prefetch settings: how many upcoming tracks to download while one plays.
+# How many downloads run at once across all guilds is set by the scheduler.
+PREFETCH_AHEAD = int(os.getenv("MUSIC_PREFETCH_AHEAD", "2"))
+
+# In-flight prefetch tasks per guild, keyed by queued URL
+prefetch_tasks = defaultdict(dict)
+
+# Progressive playback: start streaming uncached tracks immediately and write
+# the same audio into the cache while it plays
+PROGRESSIVE_PLAYBACK = os.getenv("MUSIC_PROGRESSIVE_PLAYBACK", "true").lower() not in ("false", "0", "off", "no")
+
+# Playback state per guild: idle, preparing, backoff (waiting to retry) or
+# playing. The epoch changes on !stop/!leave so an in-progress play_next
+# knows to give up.
+PLAY_MAX_RETRIES = 2          # retries per track for transient errors
+PLAY_BACKOFF_BASE = 2.0       # seconds; doubles on every retry
+PLAY_BACKOFF_MAX = 30.0
+PLAY_MAX_FAILED_TRACKS = 5    # stop after this many tracks in a row fail
+player_states = {}
+player_epochs = defaultdict(int)
+recovery_stats = {'retries': 0, 'skipped': 0, 'stopped': 0}
+
+# Gapless transitions: when the next track is already on disk its source is
+# opened (and FFmpeg started, if needed) while the current one plays, then
+# started straight from the voice client's after callback
+GAPLESS_PLAYBACK = os.getenv("MUSIC_GAPLESS", "true").lower() not in ("false", "0", "off", "no")
+prepared_sources = {}  # guild_id -> prepared next track
+track_ended_at = {}    # guild_id -> when the last track ran out
+gap_samples = defaultdict(lambda: deque(maxlen=100))
+
+# Shared streams: an uncached track is encoded once into a growing Opus file
+# that every guild playing it at the default volume reads as passthrough.
+# "buffer" starts each guild from the top, "sync" joins a guild at the
+# position another guild is already hearing, "off" gives every guild its
+# own FFmpeg pipeline.
+SHARED_STREAMS = os.getenv("MUSIC_SHARED_STREAMS", "off").lower()
+shared_streams = {}  # (key, tier) -> {'stream': SharedOpusStream, 'title': str}
+
+# Playlists are expanded in flat pages in the background; each entry is only
+# resolved and downloaded once it nears the front of the queue
+PLAYLIST_PAGE_SIZE = 50
+PLAYLIST_MAX_TRACKS = int(os.getenv("MUSIC_PLAYLIST_MAX_TRACKS", "500"))
+PLAYLIST_UNAVAILABLE_TITLES = ("[Private video]", "[Deleted video]")
+playlist_tasks = defaultdict(set)
+
+# Queue entries !queue lists before summarizing the rest
+QUEUE_DISPLAY_LIMIT = 20
+
+# Time-to-first-audio samples (seconds) per playback mode
+ttfa_samples = defaultdict(lambda: deque(maxlen=100))
+
+def record_ttfa(guild_id, mode, seconds):
+    """Record how long a play took from dequeue to the first audio frame"""
+    ttfa_samples[mode].append(seconds)
+    print(f"Time to first audio in guild {guild_id}: {seconds:.2f}s ({mode})")
+    ended_at = track_ended_at.pop(guild_id, None)
+    if ended_at is not None:
+        # Silence between the previous track's last frame and this one's first
+        gap_samples["gapless" if mode == "gapless" else "cold"].append(time.monotonic() - ended_at)
+    if guild_id in restart_pending:
+        # First audio since this process started, counted from process start
+        restart_pending.discard(guild_id)
+        restart_seconds = time.monotonic() - PROCESS_STARTED
+        ttfa_samples['restart'].append(restart_seconds)
+        print(f"Restart to audio in guild {guild_id}: {restart_seconds:.2f}s")
+
+# Track metadata cache shared by play, queue, search and play_next.
+# Maps cache key -> (expires_at, track) so queue rendering never hits YouTube.
+TRACK_METADATA_TTL = 6 * 3600
+TRACK_METADATA_MAX_ENTRIES = 1000
+track_metadata_cache = {}
+
+# Search result cache shared by !play and !search.
+# Maps normalized query -> (expires_at, [track, ...]).
+SEARCH_CACHE_TTL = 30 * 60
+SEARCH_CACHE_MAX_ENTRIES = 500
+SEARCH_RESULTS = 5
+search_cache = {}
+search_cache_stats = {'hits': 0, 'misses': 0}
+
+# Negative cache of links known not to play (removed, private, region-locked)
+# so queued dead links are skipped without another YouTube round trip.
+# Maps cache key -> (expires_at, reason).
+DEAD_URL_TTL = 6 * 3600
+DEAD_URL_MAX_ENTRIES = 2000
+dead_urls = {}
+
+# Stream-profile extractions made by !play, so the first playback of a link
+# that was just resolved reuses them instead of a second YouTube round trip.
+# Maps (cache key, tier) -> (expires_at, info); short-lived because the
+# stream URLs inside expire.
+STREAM_INFO_TTL = 20 * 60
+STREAM_INFO_MAX_ENTRIES = 200
+stream_infos = {}
+
+def ttl_cache_get(cache, key):
+    """Return a live value from a (expires_at, value) dict cache, or None"""
+    entry = cache.get(key)
+    if entry:
+        expires_at, value = entry
+        if expires_at > time.time():
+            return value
+        del cache[key]
+    return None
+
+def ttl_cache_put(cache, key, value, ttl, max_entries):
+    """Insert into a (expires_at, value) dict cache, dropping the oldest entries"""
+    cache.pop(key, None)
+    cache[key] = (time.time() + ttl, value)
+    # Dicts keep insertion order, so the first entry is the oldest
+    while len(cache) > max_entries:
+        cache.pop(next(iter(cache)))
+
+def format_duration(seconds):
+    """Render a duration in seconds as m:ss, or an empty string if unknown"""
+    if not seconds:
+        return ""
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}:{seconds:02d}"
+
+def make_track(info, url=None):
+    """Build a queue entry from a yt-dlp info dict (full or flat)"""
+    video_id = info.get('id')
+    if not url:
+        url = info.get('webpage_url') or info.get('url')
+        if not url or not url.startswith(('http://', 'https://')):
+            url = f"https://www.youtube.com/watch?v={video_id}"
+
+    thumbnail = info.get('thumbnail')
+    if not thumbnail and info.get('thumbnails'):
+        thumbnail = info['thumbnails'][-1].get('url')
+
+    return {
+        'url': url,
+        'id': video_id,
+        'title': info.get('title'),
+        'duration': info.get('duration'),
+        'thumbnail': thumbnail,
+    }
+
+def _track_cache_key(url):
+    return audio_cache.key_from_url(url) or url
+
+def remember_track(track):
+    """Store a resolved track in the metadata cache"""
+    ttl_cache_put(
+        track_metadata_cache, _track_cache_key(track['url']), track,
+        TRACK_METADATA_TTL, TRACK_METADATA_MAX_ENTRIES
+    )
+
+def get_cached_track(url):
+    """Return cached metadata for a URL without touching the network, or None"""
+    key = _track_cache_key(url)
+    track = ttl_cache_get(track_metadata_cache, key)
+    if track:
+        return dict(track, url=url)
+
+    # A track already in the audio cache carries its metadata in the sidecar
+    file_path, meta = audio_cache.lookup(key, touch=False)
+    if file_path and meta.get('title'):
+        track = make_track(meta, url)
+        remember_track(track)
+        return track
+    return None
+
+def mark_dead_url(url, error):
+    """Remember that a link can't be played"""
+    # yt-dlp messages look like "ERROR: [youtube] id: Video unavailable. ..."
+    reason = str(error).split(": ")[-1].split(".")[0].strip() or "unavailable"
+    ttl_cache_put(dead_urls, _track_cache_key(url), reason[:80], DEAD_URL_TTL, DEAD_URL_MAX_ENTRIES)
+
+def dead_url_reason(url):
+    """Why a link is known not to play, or None"""
+    return ttl_cache_get(dead_urls, _track_cache_key(url))
+
+def normalize_search_query(query):
+    """Case- and whitespace-insensitive form of a search query"""
+    return " ".join(query.casefold().split())
+
+async def search_tracks(query):
+    """Return the top YouTube results for a query as queue entries, cached"""
+    normalized = normalize_search_query(query)
+    tracks = ttl_cache_get(search_cache, normalized)
+    if tracks is not None:
+        search_cache_stats['hits'] += 1
+        return tracks
+
+    search_cache_stats['misses'] += 1
+    info = await ytdl_service.extract_info(f"ytsearch{SEARCH_RESULTS}:{normalized}", "search")
+    tracks = []
+    for entry in info.get('entries') or []:
+        track = make_track(entry, f"https://www.youtube.com/watch?v={entry['id']}")
+        # Remember each result so a follow-up !play <url> needs no lookup
+        remember_track(track)
+        tracks.append(track)
+
+    ttl_cache_put(search_cache, normalized, tracks, SEARCH_CACHE_TTL, SEARCH_CACHE_MAX_ENTRIES)
+    return tracks
+
+def take_stream_info(url, tier):
+    """Pop a fresh stream extraction for a URL and tier, or None"""
+    key = (_track_cache_key(url), tier)
+    info = ttl_cache_get(stream_infos, key)
+    stream_infos.pop(key, None)
+    return info
+
+async def resolve_track(url, tier=DEFAULT_QUALITY):
+    """Resolve a URL into a queue entry, using the metadata cache when possible"""
+    track = get_cached_track(url)
+    if track:
+        return track
+
+    try:
+        # The stream profile returns the same metadata plus a playable URL,
+        # which the track's first playback picks up from stream_infos
+        info = await ytdl_service.extract_info(url, f"stream:{tier}")
+    except Exception as e:
+        print(f"Metadata lookup failed for {url}: {e}")
+        if ytdl_service.is_permanent_error(e):
+            mark_dead_url(url, e)
+        return make_track({}, url)
+
+    track = make_track(info, url)
+    remember_track(track)
+    if info.get('url'):
+        ttl_cache_put(stream_infos, (_track_cache_key(url), tier), info, STREAM_INFO_TTL, STREAM_INFO_MAX_ENTRIES)
+    return track
 
 @bot.command()
 async def join(ctx):
@@ -296,7 +707,11 @@ async def leave(ctx):
         guild_id = ctx.guild.id
         # Clear the queue when leaving
         if guild_id in music_queues:
-            music_queues[guild_id] = []
+            music_queues[guild_id].clear()
+        cancel_prefetch(guild_id)
+        cancel_playlist_ingest(guild_id)
+        reset_player(guild_id)
+        request_checkpoint()
         
         # Stop any playing audio
         if ctx.voice_client.is_playing():
@@ -311,8 +726,6 @@ async def leave(ctx):
 async def play(ctx, *, query: str):
     """Play a song by URL or search term"""
     guild_id = ctx.guild.id
-    if guild_id not in music_queues:
-        music_queues[guild_id] = []
     
     # Join voice channel if not already in one
     if not ctx.voice_client:
@@ -327,204 +740,839 @@ async def play(ctx, *, query: str):
             message = await ctx.send("⏳ Processing song...")
             
             # Check if the query is a URL or a search term
-            if query.startswith(('http://', 'https://')):
-                # It's a URL, use it directly
-                url = query
-                await message.edit(content=f"🔎 Processing URL: {url}")
+            if query.startswith(('http://', 'https://')) and is_playlist_url(query):
+                # Expand the playlist in the background; the first page starts playback
+                await message.edit(content=f"📃 Loading playlist: {query}")
+                task = bot.loop.create_task(ingest_playlist(ctx, guild_id, query, message))
+                playlist_tasks[guild_id].add(task)
+                task.add_done_callback(playlist_tasks[guild_id].discard)
+                return
+            elif query.startswith(('http://', 'https://')):
+                # It's a URL, resolve its metadata once up front
+                await message.edit(content=f"🔎 Processing URL: {query}")
+                track = await resolve_track(query, get_quality(guild_id))
+                reason = dead_url_reason(query)
+                if reason:
+                    await message.edit(content=f"❌ Can't play that link: {reason}")
+                    return
             else:
                 # It's a search term, search YouTube
                 await message.edit(content=f"🔎 Searching YouTube for: **{query}**")
-                url = await search_youtube(query)
-                if not url:
+                track = await search_youtube(query)
+                if not track:
                     await message.edit(content=f"❌ No results found for: **{query}**")
                     return
             
-            music_queues[guild_id].append(url)
+            music_queues[guild_id].append(track)
+            request_checkpoint()
             
-            if not ctx.voice_client.is_playing():
+            if not ctx.voice_client.is_playing() and player_states.get(guild_id, "idle") == "idle":
                 await play_next(ctx, guild_id)
             else:
-                # Get song title for better user feedback
-                with youtube_dl.YoutubeDL({'quiet': True}) as ydl:
-                    try:
-                        info = ydl.extract_info(url, download=False)
-                        title = info.get('title', 'Unknown Title')
-                        await message.edit(content=f"✅ Added to queue: **{title}**")
-                    except:
-                        await message.edit(content="✅ Added to queue!")
+                schedule_prefetch(guild_id)
+                if track['title']:
+                    await message.edit(content=f"✅ Added to queue: **{track['title']}**")
+                else:
+                    await message.edit(content="✅ Added to queue!")
         except Exception as e:
             await ctx.send(f"❌ Error: {str(e)}")
 
+def is_playlist_url(url):
+    """True for playlist links; a video link that also carries list= plays just the video"""
+    parsed = urlparse(url)
+    params = parse_qs(parsed.query)
+    if parsed.netloc.endswith('youtu.be'):
+        return False
+    return ('list' in params and 'v' not in params) or '/sets/' in parsed.path
+
+async def ingest_playlist(ctx, guild_id, url, message):
+    """Append a playlist to the queue one flat page at a time"""
+    title = None
+    queued = 0
+    started_playback = False
+    pager = ytdl_service.PlaylistPager(url)
+    try:
+        while queued < PLAYLIST_MAX_TRACKS:
+            count = min(PLAYLIST_PAGE_SIZE, PLAYLIST_MAX_TRACKS - queued)
+            entries = await pager.next_page(count)
+            if entries is None:
+                # Not a playlist after all, queue it as a single track
+                track = make_track(pager.info, url)
+                remember_track(track)
+                tracks = [track]
+            else:
+                title = title or pager.info.get('title')
+                tracks = [
+                    make_track(entry) for entry in entries
+                    if entry and entry.get('title') not in PLAYLIST_UNAVAILABLE_TITLES
+                ]
+                for track in tracks:
+                    remember_track(track)
+
+            if not ctx.voice_client:
+                # Disconnected while the playlist was loading
+                return
+            music_queues[guild_id].extend(tracks)
+            queued += len(tracks)
+            request_checkpoint()
+
+            if not started_playback and not (ctx.voice_client.is_playing() or ctx.voice_client.is_paused()):
+                started_playback = True
+                # Keep paging while the first track loads (or retries)
+                bot.loop.create_task(play_next(ctx, guild_id))
+            else:
+                schedule_prefetch(guild_id)
+
+            if entries is None or len(entries) < count:
+                break
+            await message.edit(content=f"📃 Queuing **{title or url}**: {queued} tracks so far...")
+
+        await message.edit(content=f"✅ Added {queued} tracks from **{title or url}**")
+    except Exception as e:
+        print(f"Playlist error for {url}: {e}")
+        await message.edit(content=f"❌ Playlist stopped after {queued} tracks: {str(e)}")
+    finally:
+        pager.close()
+
+def cancel_playlist_ingest(guild_id):
+    """Stop expanding any playlists still loading for a guild"""
+    for task in playlist_tasks.pop(guild_id, set()):
+        task.cancel()
+
 async def search_youtube(query):
-    """Search YouTube and return the URL of the first result"""
-    search_opts = {
-        'format': 'bestaudio/best',
-        'default_search': 'ytsearch',
-        'noplaylist': True,
-        'quiet': True,
-        'no_warnings': True,
-        'extract_flat': True  # Do not download, just get info
-    }
-    
+    """Search YouTube and return the first result as a queue entry"""
     try:
-        # Add ytsearch: prefix to force a search
-        with youtube_dl.YoutubeDL(search_opts) as ydl:
-            info = ydl.extract_info(f"ytsearch:{query}", download=False)
-            
-            if 'entries' in info and info['entries']:
-                # Get the first result
-                return f"https://www.youtube.com/watch?v={info['entries'][0]['id']}"
+        # Shares cached results with !search, so searching then playing the
+        # same terms only hits YouTube once
+        tracks = await search_tracks(query)
+        if tracks:
+            # Get the first result
+            return dict(tracks[0])
     except Exception as e:
         print(f"Search error: {str(e)}")
     
     return None
 
-async def download_audio(url, guild_id):
-    """Download the audio file and return the path"""
+async def _download_to_cache(key, url, info, tier, guild_id, priority):
+    """Download one track variant into the cache; callers are deduplicated"""
+    # Check if any guild has already downloaded this track at this tier or better
+    file_path, meta = audio_cache.lookup(key, tier)
+    if file_path:
+        return file_path, meta.get('title')
+
+    # Downloads and encodes take turns across guilds through the scheduler
+    async with download_scheduler.slot(guild_id, priority, ("download", key, tier)):
+        # The track may have been cached by a stream while this job waited
+        file_path, meta = audio_cache.lookup(key, tier)
+        if file_path:
+            return file_path, meta.get('title')
+
+        # Download the file on the shared yt-dlp worker pool
+        profile = f"download:{tier}"
+        if info is None:
+            info = await ytdl_service.extract_info(url, profile, download=True)
+        else:
+            info = await ytdl_service.process_ie_result(info, profile)
+        title = info.get('title', 'Unknown Title')
+
+        # The downloaded path is reported by yt-dlp itself
+        downloads = info.get('requested_downloads') or []
+        downloaded_file = downloads[0].get('filepath') if downloads else None
+
+        if downloaded_file and os.path.exists(downloaded_file):
+            # Encode once into Discord-ready Opus, then publish atomically so
+            # readers never see a partial file
+            encoded_file = os.path.join(DOWNLOAD_DIR, f"temp_{key}.{tier}.{audio_cache.AUDIO_EXT}")
+
+            def encode_and_publish():
+                try:
+                    # Measures loudness once and bakes the normalization gain in
+                    loudness = audio_cache.encode(downloaded_file, encoded_file, tier)
+                finally:
+                    os.remove(downloaded_file)
+                # Publishing may evict older entries, so it stays off the loop too
+                return audio_cache.publish(key, tier, info, encoded_file, loudness)
+
+            return await ytdl_service.run_task("encode", encode_and_publish), title
+        else:
+            # If downloaded file not found, try to use direct URL for streaming
+            return None, title
+
+async def download_audio(url, tier=DEFAULT_QUALITY, guild_id=None, priority=download_scheduler.PLAY):
+    """Download the audio file into the shared cache and return (path, title)"""
     try:
-        # Clean filename to avoid issues
-        clean_id = ''.join(c for c in url if c.isalnum())[-10:]
-        file_path = f"{DOWNLOAD_DIR}/{guild_id}_{clean_id}.mp3"
-        temp_path = f"{DOWNLOAD_DIR}/temp_{guild_id}_{clean_id}.%(ext)s"
-        
-        # Check if we've already downloaded this file
-        if os.path.exists(file_path) and os.path.getsize(file_path) > 0:
-            return file_path, None
-        
-        # Download options with better error handling
-        ydl_opts = {
-            'format': 'bestaudio/best',
-            'outtmpl': temp_path,
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }],
-            'noplaylist': True,
-            'no_warnings': False,
-            'ignoreerrors': False,
-            'quiet': False,
-            'verbose': True,
-            'extract_flat': False,
-            'force_generic_extractor': False,
-            'cachedir': False,
-            'nocheckcertificate': True
-        }
-        
-        # Download the file
-        with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            title = info.get('title', 'Unknown Title')
-            
-            # Verify the file was created (could be with a different extension)
-            downloaded_file = None
-            for filename in os.listdir(DOWNLOAD_DIR):
-                if filename.startswith(f"temp_{guild_id}_{clean_id}") and os.path.isfile(os.path.join(DOWNLOAD_DIR, filename)):
-                    downloaded_file = os.path.join(DOWNLOAD_DIR, filename)
-                    break
-            
-            if downloaded_file and os.path.exists(downloaded_file):
-                # Rename/move to our expected mp3 path
-                shutil.move(downloaded_file, file_path)
-                return file_path, title
-            else:
-                # If downloaded file not found, try to use direct URL for streaming
-                return None, title
-                
+        # YouTube IDs can be read straight from the URL, so a cache hit needs
+        # no network round trip; other sites need one extraction for the ID
+        key = audio_cache.key_from_url(url)
+        info = None
+        if key is None:
+            info = await ytdl_service.extract_info(url)
+            key = audio_cache.key_from_info(info)
+
+        # Concurrent requests for the same track and tier share one download;
+        # a more urgent caller lifts the priority of a job that is still waiting
+        flight_key = ("download", key, tier)
+        download_scheduler.promote(flight_key, priority)
+        return await ytdl_service.single_flight(
+            flight_key, lambda: _download_to_cache(key, url, info, tier, guild_id, priority)
+        )
     except Exception as e:
         print(f"Download error: {str(e)}")
+        if ytdl_service.is_permanent_error(e):
+            mark_dead_url(url, e)
         # Return None to indicate failure
         return None, None
 
-async def play_next(ctx, guild_id):
-    if guild_id in music_queues and len(music_queues[guild_id]) > 0:
-        url = music_queues[guild_id].pop(0)
+def promote_download(url, tier, priority):
+    """Raise the scheduler priority of a queued download for a URL, if any"""
+    key = audio_cache.key_from_url(url)
+    if key:
+        download_scheduler.promote(("download", key, tier), priority)
+
+def schedule_prefetch(guild_id):
+    """Start background downloads for the next few tracks in a guild's queue"""
+    upcoming = [track['url'] for track in islice(music_queues.get(guild_id, ()), PREFETCH_AHEAD)]
+    tasks_for_guild = prefetch_tasks[guild_id]
+    tier = get_quality(guild_id)
+
+    # Drop prefetches for tracks that were skipped or removed from the window
+    for url in list(tasks_for_guild):
+        if url not in upcoming:
+            tasks_for_guild.pop(url).cancel()
+
+    for position, url in enumerate(upcoming):
+        # The head of the queue goes ahead of deeper prefetch work
+        priority = download_scheduler.NEXT if position == 0 else download_scheduler.PREFETCH
+        if url not in tasks_for_guild:
+            tasks_for_guild[url] = bot.loop.create_task(download_audio(url, tier, guild_id, priority))
+        elif position == 0:
+            promote_download(url, tier, priority)
+        if position == 0:
+            # Open the next source as soon as its file lands
+            tasks_for_guild[url].add_done_callback(lambda _task: prepare_next(guild_id))
+
+def cancel_prefetch(guild_id):
+    """Cancel every pending prefetch (and the prepared next source) for a guild"""
+    for task in prefetch_tasks.pop(guild_id, {}).values():
+        task.cancel()
+    discard_prepared(guild_id)
+
+async def normalize_cached(key, tier):
+    """Measure a track cached while streaming and bake in its loudness gain"""
+    try:
+        async with download_scheduler.slot(None, download_scheduler.PREFETCH):
+            await ytdl_service.run_task("encode", lambda: audio_cache.normalize(key, tier))
+    except Exception as e:
+        print(f"Loudness normalization failed for {key}: {e}")
+
+def publish_streamed(key, tier, info, path):
+    """Publish a progressively cached file; runs on the player thread"""
+    audio_cache.publish(key, tier, info, path)
+    # A stream can't be measured before it plays, so normalize it afterwards
+    asyncio.run_coroutine_threadsafe(normalize_cached(key, tier), bot.loop)
+
+def get_shared_stream(key, tier):
+    """Return the shared stream still encoding a track, or None"""
+    entry = shared_streams.get((key, tier))
+    if entry and entry['stream'].writing():
+        return entry
+    return None
+
+def start_shared_stream(key, tier, info, temp_path):
+    """Start one encode of a track that every guild playing it can read"""
+    flight = (key, tier)
+    entry = {'title': info.get('title'), 'stream': None}
+
+    def forget():
+        if shared_streams.get(flight) is entry:
+            del shared_streams[flight]
+
+    entry['stream'] = SharedOpusStream(
+        info['url'],
+        temp_path,
+        cache_codec_args=audio_cache.cache_codec_args(tier),
+        on_cached=lambda path: publish_streamed(key, tier, info, path),
+        # on_done runs on the stream's watcher thread
+        on_done=lambda: bot.loop.call_soon_threadsafe(forget),
+    )
+    shared_streams[flight] = entry
+    return entry
+
+def join_shared_stream(entry):
+    """Open a listener on a shared stream at the position this guild should hear"""
+    start = 0.0
+    if SHARED_STREAMS == "sync":
+        # Join where the guild furthest into the track is
+        start = max(
+            (
+                song['timer'].position for song in current_songs.values()
+                if getattr(song['timer'].original, 'shared', None) is entry['stream']
+            ),
+            default=0.0,
+        )
+    return entry['stream'].open(start)
+
+async def open_progressive_stream(url, guild_id):
+    """
+    Return (file_path, title, source) for a track.
+
+    A cached track comes back as a file path. Otherwise the source streams
+    the resolved URL straight away while teeing the audio into the cache, or
+    in shared mode reads the one encode of it that all guilds share.
+    """
+    tier = get_quality(guild_id)
+    # Shared streams are read as Opus passthrough, which only fits the default volume
+    use_shared = SHARED_STREAMS in ("buffer", "sync") and playback_gain(guild_id) == 1.0
+    key = audio_cache.key_from_url(url)
+    if key:
+        file_path, meta = audio_cache.lookup(key, tier)
+        if file_path:
+            return file_path, meta.get('title'), None
+        entry = get_shared_stream(key, tier) if use_shared else None
+        if entry:
+            # Already being encoded for another guild: no extraction, no FFmpeg
+            return None, entry['title'], join_shared_stream(entry)
+
+    info = take_stream_info(url, tier) or await ytdl_service.extract_info(url, f"stream:{tier}")
+    key = audio_cache.key_from_info(info)
+    file_path, meta = audio_cache.lookup(key, tier)
+    if file_path:
+        return file_path, meta.get('title'), None
+
+    fd, temp_path = tempfile.mkstemp(
+        dir=DOWNLOAD_DIR, prefix=f"temp_{key}.{tier}.", suffix=f".{audio_cache.AUDIO_EXT}"
+    )
+    os.close(fd)
+    if use_shared:
+        # Another guild may have started this track while we were extracting
+        entry = get_shared_stream(key, tier)
+        if entry:
+            os.remove(temp_path)
+        else:
+            entry = start_shared_stream(key, tier, info, temp_path)
+        return None, entry['title'], join_shared_stream(entry)
+
+    source = CachingFFmpegPCMAudio(
+        info['url'],
+        temp_path,
+        cache_codec_args=audio_cache.cache_codec_args(tier),
+        options=get_ffmpeg_options(guild_id, stream=True)['options'],
+        on_cached=lambda path: publish_streamed(key, tier, info, path),
+    )
+    return None, info.get('title'), source
+
+async def start_track(ctx, guild_id, track, status, fallback=False, epoch=None):
+    """
+    Open and play one track, raising if no source could be opened for it.
+
+    Each call tries one path, so an attempt costs at most one extraction:
+    progressive streaming (or a download when that is off), or with fallback
+    the alternative (a download, or a plain stream). Returns None without
+    playing if the player epoch moved past epoch (!stop or !leave) while the
+    source was being opened.
+    """
+    url = track['url']
+    tier = get_quality(guild_id)
+    started_at = time.monotonic()
+    file_path, title, progressive_source = None, None, None
+    prefetch = prefetch_tasks[guild_id].pop(url, None)
+    if PROGRESSIVE_PLAYBACK:
+        path = "download" if fallback else "progressive"
+    else:
+        path = "stream" if fallback else "download"
+
+    if prefetch and prefetch.done() and not prefetch.cancelled():
+        # The background prefetch already has the file on disk
+        file_path, title = prefetch.result()
+        prefetch = None
+
+    if not file_path and path == "progressive":
+        # Don't wait for a download: stream now and cache as we play
+        if prefetch:
+            prefetch.cancel()
+        file_path, title, progressive_source = await open_progressive_stream(url, guild_id)
+    elif not file_path and path == "download":
+        # Reuse an in-progress prefetch, otherwise download the file now
+        if prefetch and not prefetch.cancelled():
+            promote_download(url, tier, download_scheduler.PLAY)
+            file_path, title = await prefetch
+        else:
+            file_path, title = await download_audio(url, tier, guild_id)
+        if not (file_path and os.path.exists(file_path)):
+            # download_audio has already remembered a dead video
+            raise RuntimeError(dead_url_reason(url) or "download failed")
+    
+    if not title:
+        # If download failed, fall back to the title resolved at enqueue time
+        title = track.get('title') or "Unknown Track"
+    
+    # If we have a file path, play from file, otherwise try direct URL streaming
+    if file_path and os.path.exists(file_path) and os.path.getsize(file_path) > 0:
+        # Play from file
+        mode = "cache"
+        audio = open_cached_source(guild_id, file_path)
+    elif isinstance(progressive_source, SharedStreamAudio):
+        mode = "shared"
+        audio = progressive_source
+    elif progressive_source is not None:
+        mode = "progressive"
+        audio = progressive_source
+    else:
+        # Fallback to streaming
+        await status.edit(content="⚠️ Download failed, falling back to streaming mode...")
         
-        try:
-            # Send a "processing" message
-            processing_msg = await ctx.send("⏳ Downloading audio for better playback quality...")
-            
-            # Download the file instead of streaming
-            file_path, title = await asyncio.get_event_loop().run_in_executor(
-                None, lambda: asyncio.run(download_audio(url, guild_id))
-            )
-            
-            if not title:
-                # If download failed, try to get title at least
-                with youtube_dl.YoutubeDL({'quiet': True}) as ydl:
-                    try:
-                        info = ydl.extract_info(url, download=False)
-                        title = info.get('title', 'Unknown Title')
-                    except:
-                        title = "Unknown Track"
-            
-            # Store current song info
-            current_songs[guild_id] = {'title': title, 'url': url, 'file': file_path}
-            
-            # If we have a file path, play from file, otherwise try direct URL streaming
-            if file_path and os.path.exists(file_path) and os.path.getsize(file_path) > 0:
-                # Play from file
-                source = discord.PCMVolumeTransformer(
-                    discord.FFmpegPCMAudio(file_path, **get_ffmpeg_options(guild_id))
-                )
-            else:
-                # Fallback to streaming
-                await processing_msg.edit(content="⚠️ Download failed, falling back to streaming mode...")
-                
-                ydl_opts = {
-                    'format': 'bestaudio/best',
-                    'noplaylist': True,
-                    'quiet': True
-                }
-                
-                with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-                    info = ydl.extract_info(url, download=False)
-                    stream_url = info['url']
-                
-                source = discord.PCMVolumeTransformer(
-                    discord.FFmpegPCMAudio(
-                        stream_url, 
-                        **{'before_options': '-reconnect 1 -reconnect_streamed 1', 'options': '-vn'}
+        info = take_stream_info(url, tier) or await ytdl_service.extract_info(url, f"stream:{tier}")
+        stream_url = info['url']
+        
+        mode = "stream"
+        audio = discord.FFmpegPCMAudio(stream_url, **get_ffmpeg_options(guild_id, stream=True))
+    
+    if epoch is not None and player_epochs[guild_id] != epoch:
+        # Stopped while we were preparing: don't start playing after all
+        audio.cleanup()
+        return None
+
+    try:
+        # A shared stream may join partway into the track
+        offset = audio.start if mode == "shared" else 0.0
+        start_playback(ctx, guild_id, audio, mode, title, url, file_path, started_at, offset)
+    except Exception:
+        # Never leave an FFmpeg process (or shared stream listener) behind
+        audio.cleanup()
+        raise
+    return title
+
+def retry_delay(attempt):
+    """Exponential backoff before retry number attempt (1-based)"""
+    return min(PLAY_BACKOFF_BASE * 2 ** (attempt - 1), PLAY_BACKOFF_MAX)
+
+async def play_next(ctx, guild_id):
+    """
+    Play the next playable track in the guild's queue.
+
+    Runs as a small state machine (idle -> preparing -> playing, with a
+    backoff state between retries) instead of recursing on errors. Dead
+    links are skipped and remembered, transient extractor errors are retried
+    with exponential backoff a bounded number of times, and playback stops
+    after too many failed tracks in a row.
+    """
+    if player_states.get(guild_id, "idle") != "idle":
+        # Already playing or working on the next track
+        return
+    epoch = player_epochs[guild_id]
+    player_states[guild_id] = "preparing"
+    status = None
+    skipped = []
+    failures = 0
+
+    def reset():
+        # !stop, !leave or a disconnect happened while we were waiting
+        return player_epochs[guild_id] != epoch
+
+    try:
+        while music_queues.get(guild_id) and ctx.voice_client:
+            track = music_queues[guild_id].popleft()
+            url = track['url']
+            name = track.get('title') or url
+
+            reason = dead_url_reason(url)
+            if reason:
+                skipped.append(f"**{name}** ({reason})")
+                recovery_stats['skipped'] += 1
+                continue
+
+            if status is None:
+                status = await ctx.send("⏳ Preparing audio...")
+                if reset():
+                    return
+            attempt = 0
+            while True:
+                try:
+                    # The first retry takes the other path, once
+                    title = await start_track(
+                        ctx, guild_id, track, status, fallback=attempt == 1, epoch=epoch
                     )
+                except Exception as e:
+                    if reset():
+                        return
+                    if ytdl_service.is_permanent_error(e):
+                        mark_dead_url(url, e)
+                    reason = dead_url_reason(url)
+                    attempt += 1
+                    if reason or attempt > PLAY_MAX_RETRIES:
+                        print(f"Giving up on {url}: {e}")
+                        skipped.append(f"**{name}** ({reason or 'failed after retries'})")
+                        recovery_stats['skipped'] += 1
+                        break
+                    delay = retry_delay(attempt)
+                    print(f"Retrying {url} in {delay:.0f}s after error: {e}")
+                    recovery_stats['retries'] += 1
+                    player_states[guild_id] = "backoff"
+                    await status.edit(content=f"⏳ Couldn't load **{name}**, retrying in {delay:.0f}s...")
+                    await asyncio.sleep(delay)
+                    if reset():
+                        return
+                    player_states[guild_id] = "preparing"
+                    continue
+
+                if reset():
+                    # !stop or !leave came while the source was opening
+                    return
+                player_states[guild_id] = "playing"
+                content = f"🎵 Now playing: **{title}**"
+                if skipped:
+                    content += f"\n⏭️ Skipped {len(skipped)} unavailable: " + ", ".join(skipped[:5])
+                await status.edit(content=content)
+                # Get the next tracks onto disk while this one plays
+                schedule_prefetch(guild_id)
+                return
+
+            failures += 1
+            if failures >= PLAY_MAX_FAILED_TRACKS:
+                recovery_stats['stopped'] += 1
+                await status.edit(
+                    content=f"❌ Stopped after {failures} tracks in a row failed to play. "
+                    f"Use `!play` to try again.\n⏭️ Skipped: " + ", ".join(skipped[:5])
                 )
-            
-            source.volume = 0.5  # Set a safe default volume
-            
-            # Play the audio
-            ctx.voice_client.play(
-                source,
-                after=lambda e: asyncio.run_coroutine_threadsafe(
-                    handle_song_complete(ctx, guild_id, e), bot.loop
-                )
-            )
-            
-            await processing_msg.edit(content=f"🎵 Now playing: **{title}**")
-            
+                return
+            # Space out consecutive failures so a bad playlist can't hammer YouTube
+            await asyncio.sleep(retry_delay(failures))
+            if reset():
+                return
+
+        if skipped:
+            message = "⏭️ Skipped unavailable: " + ", ".join(skipped[:5])
+            if status:
+                await status.edit(content=message)
+            else:
+                await ctx.send(message)
+    finally:
+        if not reset() and player_states.get(guild_id) != "playing":
+            player_states[guild_id] = "idle"
+
+def reset_player(guild_id):
+    """Abandon any track the guild's player is preparing or retrying"""
+    player_epochs[guild_id] += 1
+    player_states[guild_id] = "idle"
+
+def start_playback(ctx, guild_id, audio, mode, title, url, file_path, started_at, offset=0.0):
+    """Play a prepared source and record it as the guild's current song"""
+    timer = TimedSource(audio, started_at, lambda seconds: record_ttfa(guild_id, mode, seconds), offset)
+
+    # Record the song only once play() accepted it, so a failed start leaves
+    # no pin and no stale current song behind
+    play_source(ctx, guild_id, timer)
+    # A cached file is pinned while it plays
+    pinned = mode == "cache"
+    if pinned:
+        audio_cache.pin(file_path)
+    set_current_song(ctx, guild_id, timer, title, url, file_path, pinned)
+    prepare_next(guild_id)
+
+def set_current_song(ctx, guild_id, timer, title, url, file_path, pinned):
+    """Store current song info; pinned means the file is pinned until it ends"""
+    current_songs[guild_id] = {
+        'title': title, 'url': url, 'file': file_path, 'timer': timer, 'pinned': pinned
+    }
+    music_channels[guild_id] = ctx.channel.id
+    request_checkpoint()
+
+def play_source(ctx, guild_id, timer):
+    """Hand a source to the voice client; also called from the player thread"""
+    ctx.voice_client.play(
+        wrap_source(guild_id, timer),
+        bitrate=audio_cache.QUALITY_TIERS[get_quality(guild_id)]['bitrate'],
+        after=lambda e: on_track_end(ctx, guild_id, e),
+    )
+
+def release_current_song(guild_id):
+    """Forget the guild's current song and unpin its cached file"""
+    song = current_songs.pop(guild_id, None)
+    if song and song.get('pinned'):
+        audio_cache.unpin(song['file'])
+
+def prepare_next(guild_id):
+    """Open the next track's source ahead of time if its file is already on disk"""
+    if not GAPLESS_PLAYBACK or guild_id not in current_songs:
+        return
+    queue = music_queues.get(guild_id)
+    if not queue:
+        return
+    track = queue[0]
+    prepared = prepared_sources.get(guild_id)
+    if prepared and prepared['url'] == track['url']:
+        return
+    discard_prepared(guild_id)
+
+    tier = get_quality(guild_id)
+    file_path, title = None, None
+    prefetch = prefetch_tasks[guild_id].get(track['url'])
+    if prefetch and prefetch.done() and not prefetch.cancelled() and prefetch.exception() is None:
+        file_path, title = prefetch.result()
+    else:
+        key = audio_cache.key_from_url(track['url'])
+        if key:
+            file_path, meta = audio_cache.lookup(key, tier, touch=False)
+            title = meta.get('title') if meta else None
+    if not file_path or not os.path.exists(file_path):
+        return
+
+    # Pinned from now so eviction can't remove it before it plays
+    audio_cache.pin(file_path)
+    prepared_sources[guild_id] = {
+        'url': track['url'],
+        'title': title or track.get('title') or "Unknown Track",
+        'file': file_path,
+        'tier': tier,
+        'gain': playback_gain(guild_id),
+        # Opens the file, or starts FFmpeg now if the volume needs PCM
+        'audio': open_cached_source(guild_id, file_path),
+    }
+
+def release_prepared(prepared):
+    prepared['audio'].cleanup()
+    audio_cache.unpin(prepared['file'])
+
+def discard_prepared(guild_id):
+    """Drop a guild's prepared next source"""
+    prepared = prepared_sources.pop(guild_id, None)
+    if prepared:
+        release_prepared(prepared)
+
+def play_prepared(ctx, guild_id):
+    """Start the prepared next track; runs on the player thread"""
+    prepared = prepared_sources.pop(guild_id, None)
+    if prepared is None:
+        return None
+    queue = music_queues.get(guild_id)
+    voice_client = ctx.voice_client
+    if (
+        not queue or queue[0]['url'] != prepared['url']
+        or prepared['gain'] != playback_gain(guild_id) or prepared['tier'] != get_quality(guild_id)
+        or not voice_client or not voice_client.is_connected()
+    ):
+        # The queue or settings changed since it was prepared
+        release_prepared(prepared)
+        return None
+
+    timer = TimedSource(
+        prepared['audio'], time.monotonic(), lambda seconds: record_ttfa(guild_id, "gapless", seconds)
+    )
+    try:
+        play_source(ctx, guild_id, timer)
+    except Exception:
+        release_prepared(prepared)
+        raise
+    return dict(prepared, timer=timer)
+
+def on_track_end(ctx, guild_id, error):
+    """Voice client after callback: swap in the prepared next track right away"""
+    track_ended_at[guild_id] = time.monotonic()
+    advanced = None
+    if not error:
+        try:
+            advanced = play_prepared(ctx, guild_id)
         except Exception as e:
-            await ctx.send(f"❌ Error playing track: {str(e)}")
-            # Try to play next song
-            await play_next(ctx, guild_id)
+            print(f"Gapless transition failed: {e}")
+    # Messages and queue bookkeeping happen on the event loop
+    asyncio.run_coroutine_threadsafe(handle_song_complete(ctx, guild_id, error, advanced), bot.loop)
 
-async def handle_song_complete(ctx, guild_id, error):
+async def handle_song_complete(ctx, guild_id, error, advanced=None):
     """Handle when a song completes playing"""
     if error:
         print(f"Player error: {error}")
     
     # Mark the song as no longer being played
-    if guild_id in current_songs:
-        del current_songs[guild_id]
+    release_current_song(guild_id)
+    if player_states.get(guild_id) == "playing":
+        player_states[guild_id] = "idle"
+
+    queue = music_queues.get(guild_id)
+    if advanced:
+        # The next track is already playing; catch the queue up with it
+        if queue and queue[0]['url'] == advanced['url']:
+            queue.popleft()
+        prefetch_tasks[guild_id].pop(advanced['url'], None)
+        set_current_song(
+            ctx, guild_id, advanced['timer'], advanced['title'], advanced['url'], advanced['file'], True
+        )
+        player_states[guild_id] = "playing"
+        await ctx.send(f"🎵 Now playing: **{advanced['title']}**")
+        schedule_prefetch(guild_id)
+        prepare_next(guild_id)
+        return
     
     # Play the next song if available
-    if guild_id in music_queues and len(music_queues[guild_id]) > 0:
+    if queue:
         await play_next(ctx, guild_id)
+    else:
+        # Nothing followed, so there is no gap to measure
+        track_ended_at.pop(guild_id, None)
+
+# Warm restart: guild music state is checkpointed to SQLite whenever it
+# changes (and every few seconds for the playback position), then restored
+# on startup
+STATE_CHECKPOINT_INTERVAL = 5
+# Replay a little of the track on resume so listeners can pick it back up
+RESUME_REWIND = 3.0
+PROCESS_STARTED = time.monotonic()
+saved_music_states = {}   # guild_id -> JSON last written
+restart_pending = set()   # guilds resumed after a restart, awaiting first audio
+checkpoint_lock = asyncio.Lock()
+music_state_restored = False
+
+class ResumeContext:
+    """Stand-in for commands.Context when playback resumes without a command"""
+
+    def __init__(self, guild, channel):
+        self.guild = guild
+        self.channel = channel
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    async def send(self, *args, **kwargs):
+        return await self.channel.send(*args, **kwargs)
+
+def snapshot_music_state(guild_id):
+    """Serializable music state for a guild, or None if there is nothing to keep"""
+    guild = bot.get_guild(guild_id)
+    voice_client = guild.voice_client if guild else None
+    queue = list(music_queues.get(guild_id, ()))
+    song = current_songs.get(guild_id)
+    state = {
+        'quality': audio_quality_settings.get(guild_id),
+        'volume': guild_volumes.get(guild_id),
+        'voice_channel_id': None,
+        'text_channel_id': None,
+        'queue': [],
+        'current': None,
+    }
+    if voice_client and voice_client.channel and (queue or song):
+        state.update(
+            voice_channel_id=voice_client.channel.id,
+            text_channel_id=music_channels.get(guild_id),
+            queue=queue,
+            current={'url': song['url'], 'title': song['title']} if song else None,
+        )
+    elif state['quality'] is None and state['volume'] is None:
+        return None
+    return state
+
+async def checkpoint_music_state():
+    """Write every guild whose music state changed, plus current positions"""
+    async with checkpoint_lock:
+        changes = {}
+        encoded = {}
+        guild_ids = (
+            set(saved_music_states) | set(music_queues) | set(current_songs)
+            | set(audio_quality_settings) | set(guild_volumes)
+        )
+        for guild_id in guild_ids:
+            state = snapshot_music_state(guild_id)
+            encoded[guild_id] = json.dumps(state, sort_keys=True) if state else None
+            if encoded[guild_id] != saved_music_states.get(guild_id):
+                changes[guild_id] = state
+        positions = {
+            guild_id: round(song['timer'].position, 1)
+            for guild_id, song in current_songs.items() if encoded.get(guild_id)
+        }
+        if not changes and not positions:
+            return
+
+        try:
+            await asyncio.to_thread(music_state.save, changes, positions)
+        except Exception as e:
+            print(f"Music state checkpoint failed: {e}")
+            return
+        for guild_id in changes:
+            if encoded[guild_id] is None:
+                saved_music_states.pop(guild_id, None)
+            else:
+                saved_music_states[guild_id] = encoded[guild_id]
+
+def request_checkpoint():
+    """Checkpoint music state soon after a change"""
+    bot.loop.create_task(checkpoint_music_state())
+
+@tasks.loop(seconds=STATE_CHECKPOINT_INTERVAL)
+async def state_checkpoint_task():
+    """Background task that keeps saved playback positions fresh"""
+    await checkpoint_music_state()
+
+async def resume_current_track(ctx, guild_id, current, position):
+    """Resume the saved current track from its cached file near its last position"""
+    url, title = current['url'], current.get('title') or "Unknown Track"
+    key = audio_cache.key_from_url(url)
+    file_path = audio_cache.lookup(key)[0] if key else None
+    if not file_path:
+        # It was still streaming when we stopped, so it never reached the cache
+        music_queues[guild_id].appendleft(make_track({'title': title}, url))
+        await play_next(ctx, guild_id)
+        return
+
+    position = max(0.0, position - RESUME_REWIND)
+    audio = open_cached_source(guild_id, file_path, start=position)
+    start_playback(ctx, guild_id, audio, "cache", title, url, file_path, time.monotonic(), offset=position)
+    player_states[guild_id] = "playing"
+    await ctx.send(f"🔄 Resumed **{title}** at {format_duration(position) or '0:00'} after a restart")
+    schedule_prefetch(guild_id)
+
+async def resume_guild(guild_id, state):
+    """Restore one guild's settings and queue, rejoin voice and resume playback"""
+    guild = bot.get_guild(guild_id)
+    if guild is None:
+        return
+    if state.get('quality') in audio_cache.QUALITY_TIERS:
+        audio_quality_settings[guild_id] = state['quality']
+    if state.get('volume') is not None:
+        guild_volumes[guild_id] = state['volume']
+
+    voice_channel = guild.get_channel(state.get('voice_channel_id') or 0)
+    text_channel = guild.get_channel(state.get('text_channel_id') or 0)
+    if voice_channel is None or text_channel is None:
+        return
+
+    music_queues[guild_id].extend(state.get('queue') or [])
+    if not guild.voice_client:
+        await voice_channel.connect()
+    restart_pending.add(guild_id)
+    ctx = ResumeContext(guild, text_channel)
+    if state.get('current'):
+        await resume_current_track(ctx, guild_id, state['current'], state.get('position') or 0.0)
+    elif music_queues[guild_id]:
+        await play_next(ctx, guild_id)
+
+async def restore_music_state():
+    """Resume every guild that was playing before the last restart"""
+    states = await asyncio.to_thread(music_state.load_all)
+    # Rows are rewritten (or dropped) by the next checkpoint
+    saved_music_states.update({guild_id: "" for guild_id in states})
+    results = await asyncio.gather(
+        *(resume_guild(guild_id, state) for guild_id, state in states.items()),
+        return_exceptions=True,
+    )
+    for guild_id, result in zip(states, results):
+        if isinstance(result, Exception):
+            print(f"Could not resume music in guild {guild_id}: {result}")
+    if states:
+        print(f"Restored music state for {len(states)} guilds")
+    if not state_checkpoint_task.is_running():
+        state_checkpoint_task.start()
 
 @bot.command()
 async def stop(ctx):
-    if ctx.voice_client and ctx.voice_client.is_playing():
-        ctx.voice_client.stop()
-        guild_id = ctx.guild.id
+    guild_id = ctx.guild.id
+    if ctx.voice_client and (ctx.voice_client.is_playing() or player_states.get(guild_id, "idle") != "idle"):
+        # Clear first so the after callback has nothing to advance to
         if guild_id in music_queues:
-            music_queues[guild_id] = []
+            music_queues[guild_id].clear()
+        cancel_prefetch(guild_id)
+        cancel_playlist_ingest(guild_id)
+        reset_player(guild_id)
+        request_checkpoint()
+        ctx.voice_client.stop()
         await ctx.send("🛑 Music stopped and queue cleared.")
     else:
         await ctx.send("No music is playing.")
@@ -554,16 +1602,19 @@ async def queue(ctx):
     if guild_id in current_songs:
         queue_list += f"▶️ Now playing: **{current_songs[guild_id]['title']}**\n\n"
     
-    for i, url in enumerate(music_queues[guild_id]):
-        with youtube_dl.YoutubeDL({'quiet': True}) as ydl:
-            try:
-                info = ydl.extract_info(url, download=False)
-                title = info.get('title', 'Unknown Title')
-                queue_list += f"{i+1}. {title}\n"
-            except:
-                queue_list += f"{i+1}. {url}\n"
+    # Entries carry their metadata from enqueue time, so no lookups here.
+    # A playlist can queue hundreds of tracks, so only the next few are listed.
+    queued = music_queues[guild_id]
+    for i, track in enumerate(islice(queued, QUEUE_DISPLAY_LIMIT)):
+        title = track['title'] or track['url']
+        duration = format_duration(track['duration'])
+        queue_list += f"{i+1}. {title}" + (f" ({duration})" if duration else "") + "\n"
+    if len(queued) > QUEUE_DISPLAY_LIMIT:
+        queue_list += f"…and {len(queued) - QUEUE_DISPLAY_LIMIT} more\n"
     
-    await ctx.send(queue_list)
+    # Long titles can still push the list past Discord's message limit
+    for chunk in chunk_message(queue_list):
+        await ctx.send(chunk)
 
 @bot.command()
 async def volume(ctx, volume: int = None):
@@ -572,8 +1623,9 @@ async def volume(ctx, volume: int = None):
         await ctx.send("Nothing is playing right now.")
         return
     
+    guild_id = ctx.guild.id
     if volume is None:
-        current_vol = int(ctx.voice_client.source.volume * 100)
+        current_vol = guild_volumes.get(guild_id, DEFAULT_VOLUME)
         await ctx.send(f"🔊 Current volume: **{current_vol}%**")
         return
     
@@ -581,9 +1633,105 @@ async def volume(ctx, volume: int = None):
         await ctx.send("⚠️ Volume must be between 0 and 100")
         return
     
-    ctx.voice_client.source.volume = volume / 100
+    guild_volumes[guild_id] = volume
+    request_checkpoint()
+    source = ctx.voice_client.source
+    song = current_songs.get(guild_id)
+    if song and song.get('file'):
+        # Reopen the cached file at the current position: FFmpeg applies the
+        # new volume, and the default volume goes back to Opus passthrough,
+        # so there is never a per-frame gain stage for cached tracks
+        old_timer = song['timer']
+        if not (old_timer.is_opus() and playback_gain(guild_id) == 1.0):
+            timer = TimedSource(
+                open_cached_source(guild_id, song['file'], start=old_timer.position),
+                time.monotonic(), None, offset=old_timer.position
+            )
+            song['timer'] = timer
+            swap_source(ctx.voice_client, guild_id, wrap_source(guild_id, timer))
+            # The player thread may still be inside a read of the old source
+            bot.loop.call_later(1, old_timer.cleanup)
+    elif isinstance(source, LiveGainSource) and isinstance(source.original, OpusDecodeSource) \
+            and playback_gain(guild_id) == 1.0:
+        # Back to the default volume: send the shared stream's packets as-is again
+        swap_source(ctx.voice_client, guild_id, source.original.original)
+    elif isinstance(source, LiveGainSource):
+        # Streams can't be reopened cheaply; scale them until the next track
+        source.set_volume(playback_gain(guild_id))
+    elif source.is_opus():
+        # A shared stream listener: decode its packets so the volume can be applied
+        gain_source = LiveGainSource(OpusDecodeSource(source))
+        gain_source.set_volume(playback_gain(guild_id))
+        swap_source(ctx.voice_client, guild_id, gain_source)
+    # A prepared next track was opened at the old volume
+    discard_prepared(guild_id)
+    prepare_next(guild_id)
     await ctx.send(f"🔊 Volume set to **{volume}%**")
 
+@bot.command()
+async def musicstats(ctx):
+    """Show music pipeline metrics (yt-dlp timings and time to first audio)"""
+    metrics = ytdl_service.get_metrics()
+    lines = [
+        f"📊 **yt-dlp workers:** {metrics['workers']} | **pending jobs:** {metrics['pending']}",
+        f"🔁 **Deduplicated requests:** {metrics['single_flight']['joined']} "
+        f"(in flight: {metrics['inflight']})",
+    ]
+    scheduler = download_scheduler.get_stats()
+    waiting = ", ".join(f"{count} {name}" for name, count in scheduler['waiting'].items() if count)
+    lines.append(
+        f"📥 **Download slots:** {scheduler['active']}/{scheduler['slots']} busy | "
+        f"**waiting:** {waiting or 'none'} across {scheduler['waiting_guilds']} servers"
+    )
+    for name, stats in scheduler['priorities'].items():
+        lines.append(
+            f"`{name}` downloads: {stats['granted']} started, "
+            f"slot wait avg {stats['wait_avg']:.2f}s / max {stats['wait_max']:.2f}s"
+        )
+    if shared_streams:
+        listeners = sum(entry['stream'].listeners for entry in shared_streams.values())
+        lines.append(
+            f"📡 **Shared streams ({SHARED_STREAMS}):** {len(shared_streams)} tracks encoding "
+            f"for {listeners} listeners"
+        )
+    lookups = search_cache_stats['hits'] + search_cache_stats['misses']
+    lines.append(
+        f"🔎 **Search cache:** {search_cache_stats['hits']} hits, {search_cache_stats['misses']} misses"
+        + (f" ({search_cache_stats['hits'] / lookups:.0%} hit rate)" if lookups else "")
+        + f", {len(search_cache)} queries cached"
+    )
+    lines.append(
+        f"🩹 **Playback recovery:** {recovery_stats['retries']} retries, "
+        f"{recovery_stats['skipped']} tracks skipped, {recovery_stats['stopped']} queues stopped, "
+        f"{len(dead_urls)} dead links remembered"
+    )
+    cache = audio_cache.cache_stats()
+    lines.append(
+        f"💾 **Cache:** {cache['total_bytes'] / (1024 * 1024):.1f}/{audio_cache.MAX_CACHE_SIZE_MB} MB, "
+        f"{cache['entries']} tracks, {cache['pinned']} playing, "
+        f"{cache['evictions']} evicted ({cache['policy'].upper()})"
+    )
+    for kind, samples in sorted(gap_samples.items()):
+        if samples:
+            lines.append(
+                f"⏭️ Gap between tracks (`{kind}`): avg {sum(samples) / len(samples) * 1000:.0f} ms, "
+                f"max {max(samples) * 1000:.0f} ms over {len(samples)} transitions"
+            )
+    for mode, samples in sorted(ttfa_samples.items()):
+        if samples:
+            lines.append(
+                f"⏱️ Time to first audio (`{mode}`): avg {sum(samples) / len(samples):.2f}s, "
+                f"last {samples[-1]:.2f}s over {len(samples)} plays"
+            )
+    for profile, stats in sorted(metrics['profiles'].items()):
+        lines.append(
+            f"`{profile}`: {stats['jobs']} jobs, "
+            f"wait avg {stats['wait_avg']:.2f}s (max {stats['wait_max']:.2f}s), "
+            f"run avg {stats['run_avg']:.2f}s (max {stats['run_max']:.2f}s), "
+            f"{stats['failed']} failed, {stats['cancelled']} cancelled"
+        )
+    await ctx.send("\n".join(lines))
+
 @bot.event
 async def on_voice_state_update(member, before, after):
     """Clean up when the bot is disconnected from a voice channel"""
@@ -591,9 +1739,12 @@ async def on_voice_state_update(member, before, after):
         # Bot was disconnected
         guild_id = before.channel.guild.id
         if guild_id in music_queues:
-            music_queues[guild_id] = []
-        if guild_id in current_songs:
-            del current_songs[guild_id]
+            music_queues[guild_id].clear()
+        cancel_prefetch(guild_id)
+        cancel_playlist_ingest(guild_id)
+        reset_player(guild_id)
+        request_checkpoint()
+        release_current_song(guild_id)
 
 # Announcement System with Embed Support
 @bot.command()
@@ -693,14 +1844,14 @@ async def post_rules(ctx):
 async def info(ctx):
     embed = discord.Embed(title="🛠 Proton Bot Commands", description="Here is a list of available commands:", color=discord.Color.green())
     embed.add_field(name="🔹 Admin Commands", value="!kick, !ban, !clear, !cleanup", inline=False)
-    embed.add_field(name="🎵 Music Commands", value="!join, !leave, !play [URL or song name], !search [song name], !skip, !stop, !queue, !volume [0-100]", inline=False)
+    embed.add_field(name="🎵 Music Commands", value="!join, !leave, !play [URL or song name], !search [song name], !skip, !stop, !queue, !volume [0-100], !musicstats", inline=False)
     embed.add_field(name="⏰ Reminders", value="!remindme [interval_minutes] [total_duration] [message] (duration supports m/h, e.g. `2h`)\n!cancelreminder", inline=False)
     ai_details = f"!askollama [prompt] (uses {DEFAULT_OLLAMA_MODEL} via Ollama"
     if OLLAMA_ALLOWED_ROLE:
         ai_details += f"; requires `{OLLAMA_ALLOWED_ROLE}` role"
     elif OLLAMA_REQUIRE_MANAGE_MESSAGES:
         ai_details += "; requires Manage Messages permission"
-    ai_details += ")"
+    ai_details += ")\n!aistats"
     if AI_CHAT_CHANNEL_NAMES:
         channel_list = ", ".join(sorted(AI_CHAT_CHANNEL_NAMES))
         ai_details += f"\nAI lounge chat in: {channel_list}"
@@ -722,46 +1873,31 @@ async def search(ctx, *, query: str):
         try:
             message = await ctx.send(f"🔎 Searching YouTube for: **{query}**")
             
-            # Search YouTube for multiple results
-            search_opts = {
-                'format': 'bestaudio/best',
-                'default_search': 'ytsearch5',  # Get top 5 results
-                'noplaylist': True,
-                'quiet': True,
-                'no_warnings': True,
-                'extract_flat': True
-            }
+            # Search YouTube for multiple results (top 5)
+            tracks = await search_tracks(query)
             
-            with youtube_dl.YoutubeDL(search_opts) as ydl:
-                info = ydl.extract_info(f"ytsearch5:{query}", download=False)
-                
-                if 'entries' not in info or not info['entries']:
-                    await message.edit(content=f"❌ No results found for: **{query}**")
-                    return
-                
-                results = []
-                for i, entry in enumerate(info['entries'], 1):
-                    video_url = f"https://www.youtube.com/watch?v={entry['id']}"
-                    title = entry.get('title', 'Unknown Title')
-                    duration = entry.get('duration')
-                    
-                    time_str = ""
-                    if duration:
-                        minutes, seconds = divmod(duration, 60)
-                        time_str = f" ({minutes}:{seconds:02d})"
-                    
-                    results.append(f"{i}. **{title}**{time_str}\n   `!play {video_url}`")
-                
-                # Create embed for results
-                embed = discord.Embed(
-                    title=f"🔍 Search Results for '{query}'",
-                    description="\n".join(results),
-                    color=discord.Color.blue()
-                )
-                embed.set_footer(text="To play a song, use the command shown below each result.")
-                
-                await message.edit(content=None, embed=embed)
+            if not tracks:
+                await message.edit(content=f"❌ No results found for: **{query}**")
+                return
+            
+            results = []
+            for i, track in enumerate(tracks, 1):
+                title = track['title'] or 'Unknown Title'
+                duration = format_duration(track['duration'])
+                time_str = f" ({duration})" if duration else ""
                 
+                results.append(f"{i}. **{title}**{time_str}\n   `!play {track['url']}`")
+            
+            # Create embed for results
+            embed = discord.Embed(
+                title=f"🔍 Search Results for '{query}'",
+                description="\n".join(results),
+                color=discord.Color.blue()
+            )
+            embed.set_footer(text="To play a song, use the command shown below each result.")
+            
+            await message.edit(content=None, embed=embed)
+            
         except Exception as e:
             await ctx.send(f"❌ Error during search: {str(e)}")
 
@@ -934,18 +2070,18 @@ async def tool_scrape(url: str) -> str:
     """Lightweight webpage scraper"""
     try:
         import trafilatura
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, timeout=15) as resp:
-                html = await resp.text()
-                text = trafilatura.extract(html)
-                return (text or "")[:1500]
+        session = await get_http_session()
+        async with session.get(url, timeout=SCRAPE_TIMEOUT) as resp:
+            html = await resp.text()
+            text = trafilatura.extract(html)
+            return (text or "")[:1500]
     except Exception as e:
         return f"(scrape failed: {e})"
 
 
-async def tool_answer(prompt: str, model: str) -> str:
+async def tool_answer(prompt: str, model: str, guild_id=None, user_id=None) -> str:
     """Final answer generation"""
-    return await _ollama_raw(prompt, model)
+    return await _ollama_raw(prompt, model, guild_id=guild_id, user_id=user_id)
 
 # -------------------------
 # Agent Prompt Builder
@@ -988,13 +2124,13 @@ Previous steps:
 # Agent Controller Loop
 # -------------------------
 
-async def agent_answer(user_query, model=DEFAULT_OLLAMA_MODEL, max_steps=5):
+async def agent_answer(user_query, model=DEFAULT_OLLAMA_MODEL, max_steps=5, guild_id=None, user_id=None):
     context = ""
     steps = []
 
     for _ in range(max_steps):
         prompt = build_agent_prompt(user_query, context, steps)
-        raw = await _ollama_raw(prompt, model)
+        raw = await _ollama_raw(prompt, model, guild_id=guild_id, user_id=user_id)
 
         try:
             decision = json.loads(raw)
@@ -1027,7 +2163,7 @@ async def agent_answer(user_query, model=DEFAULT_OLLAMA_MODEL, max_steps=5):
     return "⚠️ I couldn’t complete this request in time."
 
 # Ollama Integration
-async def query_ollama(prompt, model=DEFAULT_OLLAMA_MODEL):
+async def query_ollama(prompt, model=DEFAULT_OLLAMA_MODEL, guild_id=None, user_id=None):
     """
     Agentic Ollama query function.
 
@@ -1036,6 +2172,8 @@ async def query_ollama(prompt, model=DEFAULT_OLLAMA_MODEL):
     - Perform DuckDuckGo search when needed
     - Optionally scrape top pages for more context
     - Ground final answer with or without web data
+
+    guild_id and user_id place the Ollama calls in llm_scheduler's rotation.
     """
 
     if not OLLAMA_BASE_URL:
@@ -1064,7 +2202,7 @@ User question:
 {prompt}
 """
 
-    decision_response = await _ollama_raw(decision_prompt, model)
+    decision_response = await _ollama_raw(decision_prompt, model, guild_id=guild_id, user_id=user_id)
     try:
         import json
         decision = json.loads(decision_response)
@@ -1119,16 +2257,15 @@ User question:
         and len(web_context.strip()) < 200
     ):
         try:
-            import aiohttp
             import trafilatura
 
-            async with aiohttp.ClientSession() as session:
-                for url in sources[:2]:  # hard cap: 2 pages
-                    async with session.get(url, timeout=15) as resp:
-                        html = await resp.text()
-                        text = trafilatura.extract(html)
-                        if text:
-                            scraped_content += f"\nSource ({url}):\n{text[:1500]}\n"
+            session = await get_http_session()
+            for url in sources[:2]:  # hard cap: 2 pages
+                async with session.get(url, timeout=SCRAPE_TIMEOUT) as resp:
+                    html = await resp.text()
+                    text = trafilatura.extract(html)
+                    if text:
+                        scraped_content += f"\nSource ({url}):\n{text[:1500]}\n"
         except Exception:
             pass
 
@@ -1166,11 +2303,11 @@ User question:
 Answer:
 """.strip()
 
-    return await _ollama_raw(final_prompt, model)
+    return await _ollama_raw(final_prompt, model, guild_id=guild_id, user_id=user_id)
 
 
-async def _ollama_raw(prompt, model):
-    """Low-level Ollama call without agent logic."""
+async def _ollama_raw(prompt, model, priority=llm_scheduler.INTERACTIVE, guild_id=None, user_id=None):
+    """Low-level Ollama call without agent logic; holds one llm_scheduler slot."""
     url = OLLAMA_BASE_URL.rstrip("/") + "/api/generate"
     payload = {
         "model": model,
@@ -1178,15 +2315,56 @@ async def _ollama_raw(prompt, model):
         "stream": False
     }
 
-    timeout = aiohttp.ClientTimeout(total=120)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        async with session.post(url, json=payload) as response:
+    session = await get_http_session()
+    async with llm_scheduler.slot(guild_id, user_id, priority):
+        async with session.post(url, json=payload, timeout=OLLAMA_TIMEOUT) as response:
             if response.status != 200:
                 raise RuntimeError(f"Ollama error {response.status}")
             data = await response.json()
             return (data.get("response") or "").strip()
 
 
+async def _ollama_stream(prompt, model, on_token, priority=llm_scheduler.INTERACTIVE,
+                         guild_id=None, user_id=None, context=None, on_done=None):
+    """
+    Ollama call that passes each generated piece to on_token; returns the full text.
+
+    context continues from an earlier call's returned context, and on_done
+    receives the final stream object (new context and timing stats).
+    """
+    url = OLLAMA_BASE_URL.rstrip("/") + "/api/generate"
+    payload = {
+        "model": model,
+        "prompt": prompt,
+        "stream": True
+    }
+    if context:
+        payload["context"] = context
+
+    parts = []
+    session = await get_http_session()
+    async with llm_scheduler.slot(guild_id, user_id, priority):
+        async with session.post(url, json=payload, timeout=OLLAMA_STREAM_TIMEOUT) as response:
+            if response.status != 200:
+                raise RuntimeError(f"Ollama error {response.status}")
+            # One JSON object per line until "done"
+            async for line in response.content:
+                if not line.strip():
+                    continue
+                data = json.loads(line)
+                if data.get("error"):
+                    raise RuntimeError(f"Ollama error: {data['error']}")
+                token = data.get("response") or ""
+                if token:
+                    parts.append(token)
+                    on_token(token)
+                if data.get("done"):
+                    if on_done is not None:
+                        on_done(data)
+                    break
+    return "".join(parts).strip()
+
+
 @bot.command()
 @commands.cooldown(1, 30, commands.BucketType.user)
 async def askollama(ctx, *, prompt: str = None):
@@ -1216,16 +2394,27 @@ async def askollama(ctx, *, prompt: str = None):
 
     status_message = await ctx.send("🤖 Contacting Ollama...")
 
+    async def on_queued(position):
+        await status_message.edit(content=f"⏳ Ollama is busy, you're #{position} in line...")
+
     try:
-        reply = await run_agent(cleaned_prompt)
+        # The answer replaces the status message as it is written
+        streamed, reply = await stream_reply(
+            ctx.channel,
+            lambda on_token: run_agent(
+                cleaned_prompt, on_token, guild_id=ctx.guild.id if ctx.guild else None,
+                user_id=ctx.author.id, priority=llm_scheduler.INTERACTIVE, on_queued=on_queued,
+            ),
+            status_message,
+        )
         if not reply:
             reply = "(Ollama returned an empty response.)"
 
-        safe_reply = sanitize_for_discord(reply)
-
-        await status_message.edit(content="✅ Response received:")
-        for chunk in chunk_message(safe_reply):
-            await ctx.send(chunk)
+        await streamed.render(reply)
+    except llm_scheduler.LLMBusy as exc:
+        # Shed before it cost anything, so don't make them wait out the cooldown
+        askollama.reset_cooldown(ctx)
+        await status_message.edit(content=f"🚦 Ollama is busy ({exc}). Please try again in a minute.")
     except Exception as exc:
         await status_message.edit(content="❌ Failed to fetch response from Ollama.")
         await ctx.send(f"Error: {exc}")
@@ -1237,18 +2426,35 @@ async def handle_ai_channel_message(message):
     history = ai_channel_history[channel_id]
 
     user_turn = describe_user_message(message)
-    history.append(("user", user_turn))
-
-    prompt = build_ai_chat_prompt(history)
+    prompt, session = next_ai_turn(channel_id, history, user_turn)
+    final = {}
 
     import traceback
 
     try:
         async with message.channel.typing():
-            reply = await run_agent(prompt)
+            # Lounge chat goes straight to the model (no agent tools or answer
+            # cache) so the conversation can continue from Ollama's context
+            streamed, reply = await stream_reply(
+                message.channel,
+                lambda on_token: _ollama_stream(
+                    prompt, DEFAULT_OLLAMA_MODEL, on_token, llm_scheduler.CHAT,
+                    guild_id=message.guild.id if message.guild else None, user_id=message.author.id,
+                    context=session['context'] if session else None, on_done=final.update,
+                ),
+            )
+    except llm_scheduler.LLMBusy as exc:
+        # Never answered, so don't keep it as context for the next turn
+        if history and history[-1] == ("user", user_turn):
+            history.pop()
+        await message.channel.send(
+            f"🚦 I'm busy right now ({exc}, {exc.waiting} in line). Try me again in a minute!"
+        )
+        return
     except Exception as exc:
         # Log full traceback for systemd / journalctl
         traceback.print_exc()
+        ai_sessions.pop(channel_id, None)
 
         # Send safe but informative message to Discord
         error_text = repr(exc) if exc else "Unknown error (check server logs)"
@@ -1259,14 +2465,55 @@ async def handle_ai_channel_message(message):
         return
 
     if not reply:
-        await message.channel.send("🤔 I didn't get a response from the model that time.")
+        if streamed.messages:
+            await streamed.render("🤔 I didn't get a response from the model that time.")
+        else:
+            await message.channel.send("🤔 I didn't get a response from the model that time.")
         return
 
     safe_reply = sanitize_for_discord(reply)
     history.append(("assistant", safe_reply))
 
-    for chunk in chunk_message(safe_reply):
-        await message.channel.send(chunk)
+    record_prefill(channel_id, "reused" if session else "fresh", final)
+    if final.get('context'):
+        ai_sessions[channel_id] = {
+            'context': final['context'],
+            'model': DEFAULT_OLLAMA_MODEL,
+        }
+    else:
+        ai_sessions.pop(channel_id, None)
+
+    await streamed.render(reply)
+
+
+@bot.command()
+async def aistats(ctx):
+    """Show the AI request queue: slots in use, waiting requests and wait times"""
+    stats = llm_scheduler.get_stats()
+    waiting = ", ".join(f"{count} {name}" for name, count in stats['waiting'].items() if count)
+    lines = [
+        f"🤖 **Ollama slots:** {stats['active']}/{stats['slots']} busy | **waiting:** {waiting or 'none'}"
+    ]
+    for name, priority in sorted(stats['priorities'].items()):
+        lines.append(
+            f"`{name}`: {priority['granted']} served, {priority['shed']} turned away, "
+            f"wait avg {priority['wait_avg']:.2f}s / max {priority['wait_max']:.2f}s"
+        )
+    for kind, samples in sorted(ai_prefill_samples.items()):
+        if samples:
+            lines.append(
+                f"💬 Lounge prefill (`{kind}` context): avg {sum(t for t, _ in samples) / len(samples) * 1000:.0f} ms, "
+                f"{sum(n for _, n in samples) / len(samples):.0f} tokens over {len(samples)} turns"
+            )
+    cache = await asyncio.to_thread(agent_cache.cache_stats)
+    lines.append(
+        f"💾 **Answer cache:** {cache['hit_rate']:.0%} hit rate "
+        f"({cache['l1_hits']} memory, {cache['db_hits']} disk, {cache['semantic_hits']} similar, "
+        f"{cache['misses']} misses), "
+        f"{cache['rows']} answers / {cache['bytes'] / (1024 * 1024):.1f} MB, "
+        f"{cache['expired']} expired, {cache['evictions']} evicted"
+    )
+    await ctx.send("\n".join(lines))
 
 
 @askollama.error
@@ -1307,4 +2554,6 @@ async def userinfo(ctx, member: discord.Member = None):
     embed.set_thumbnail(url=member.avatar.url)
     await ctx.send(embed=embed)
 
-bot.run(TOKEN)
+# Importable without connecting (bench_music.py drives the music path directly)
+if __name__ == "__main__":
+    bot.run(TOKEN)
@@ -0,0 +1,342 @@
+import asyncio
+import copy
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import yt_dlp as youtube_dl
+
+from audio_cache import DOWNLOAD_DIR, QUALITY_TIERS, key_from_url
+
+
+# -------------------------
+# YT-DLP EXTRACTION / DOWNLOAD SERVICE
+# -------------------------
+# Every yt-dlp call (and the cache transcode that follows a download) goes
+# through one bounded thread pool so this work never blocks the Discord
+# gateway. Each worker thread keeps one YoutubeDL instance per option profile
+# instead of building a new one per call.
+
+YTDL_WORKERS = int(os.getenv("YTDL_WORKERS", "2"))
+
+
+def _check_cancelled(_progress):
+    """Progress hook that aborts a running download once its job is cancelled."""
+    cancel_event = getattr(_local, "cancel_event", None)
+    if cancel_event is not None and cancel_event.is_set():
+        raise youtube_dl.utils.DownloadCancelled()
+
+
+PROFILES = {
+    "metadata": {
+        "quiet": True,
+        "noplaylist": True,
+    },
+    "search": {
+        "format": "bestaudio/best",
+        "default_search": "ytsearch",
+        "noplaylist": True,
+        "quiet": True,
+        "no_warnings": True,
+        "extract_flat": True,
+    },
+    # Flat playlist entries (IDs and titles only), read a page at a time
+    # through PlaylistPager
+    "playlist": {
+        "quiet": True,
+        "no_warnings": True,
+        "extract_flat": "in_playlist",
+    },
+    "stream": {
+        "format": "bestaudio/best",
+        "noplaylist": True,
+        "quiet": True,
+    },
+    # Raw download only; the cache encode runs as a separate pool job
+    "download": {
+        "format": "bestaudio/best",
+        "outtmpl": f"{DOWNLOAD_DIR}/temp_%(extractor_key)s-%(id)s.%(format_id)s.raw.%(ext)s",
+        "noplaylist": True,
+        "no_warnings": False,
+        "ignoreerrors": False,
+        "quiet": False,
+        "verbose": True,
+        "extract_flat": False,
+        "force_generic_extractor": False,
+        "cachedir": False,
+        "nocheckcertificate": True,
+    },
+}
+
+# Per-tier variants pick a smaller source stream for lower tiers. Their raw
+# files are named by tier too: tiers can share a source format, and callers
+# only deduplicate downloads per (track, tier), so two tiers of one track
+# may download at once and must not write the same temp file.
+for _tier, _settings in QUALITY_TIERS.items():
+    PROFILES[f"download:{_tier}"] = dict(
+        PROFILES["download"],
+        format=_settings["format"],
+        outtmpl=f"{DOWNLOAD_DIR}/temp_%(extractor_key)s-%(id)s.{_tier}.%(format_id)s.raw.%(ext)s",
+    )
+    PROFILES[f"stream:{_tier}"] = dict(PROFILES["stream"], format=_settings["format"])
+
+# yt-dlp error messages meaning a video will not play however often we try,
+# as opposed to network trouble or rate limiting, which is worth retrying
+PERMANENT_ERRORS = (
+    "video unavailable",
+    "this video is not available",
+    "private video",
+    "has been removed",
+    "account associated with this video has been terminated",
+    "not available in your country",
+    "blocked it in your country",
+    "sign in to confirm your age",
+    "members-only",
+    "premieres in",
+    "unsupported url",
+    "is not a valid url",
+    "http error 404",
+    "http error 410",
+)
+
+_executor = ThreadPoolExecutor(max_workers=YTDL_WORKERS, thread_name_prefix="ytdl")
+_local = threading.local()
+
+_metrics_lock = threading.Lock()
+_metrics = defaultdict(lambda: {
+    "jobs": 0,
+    "started": 0,
+    "failed": 0,
+    "cancelled": 0,
+    "wait_total": 0.0,
+    "wait_max": 0.0,
+    "run_total": 0.0,
+    "run_max": 0.0,
+})
+_pending = 0
+
+# In-flight jobs by key; concurrent callers with the same key share one job
+_inflight = {}
+_flight_stats = {"leaders": 0, "joined": 0}
+
+
+def _get_ydl(profile: str):
+    """Return this worker thread's YoutubeDL instance for a profile."""
+    instances = getattr(_local, "instances", None)
+    if instances is None:
+        instances = _local.instances = {}
+    ydl = instances.get(profile)
+    if ydl is None:
+        opts = dict(PROFILES[profile])
+        opts["progress_hooks"] = [_check_cancelled]
+        ydl = instances[profile] = youtube_dl.YoutubeDL(opts)
+    return ydl
+
+
+def _record(name: str, field: str, value: float):
+    with _metrics_lock:
+        stats = _metrics[name]
+        stats[f"{field}_total"] += value
+        stats[f"{field}_max"] = max(stats[f"{field}_max"], value)
+
+
+def _count(name: str, field: str):
+    with _metrics_lock:
+        _metrics[name][field] += 1
+
+
+async def run_task(name: str, fn):
+    """
+    Run fn() on the worker pool, recording metrics under name.
+
+    Cancelling the awaiting task drops the job if it has not started yet,
+    and aborts an in-progress download at its next progress update.
+    """
+    global _pending
+
+    loop = asyncio.get_running_loop()
+    cancel_event = threading.Event()
+    queued_at = time.monotonic()
+
+    def job():
+        started = time.monotonic()
+        _count(name, "started")
+        _record(name, "wait", started - queued_at)
+        if cancel_event.is_set():
+            raise youtube_dl.utils.DownloadCancelled()
+        _local.cancel_event = cancel_event
+        try:
+            return fn()
+        finally:
+            _local.cancel_event = None
+            _record(name, "run", time.monotonic() - started)
+
+    _count(name, "jobs")
+    _pending += 1
+    try:
+        return await loop.run_in_executor(_executor, job)
+    except asyncio.CancelledError:
+        cancel_event.set()
+        _count(name, "cancelled")
+        raise
+    except Exception:
+        _count(name, "failed")
+        raise
+    finally:
+        _pending -= 1
+
+
+async def run(profile: str, fn):
+    """Run fn(ydl) on the worker pool with the profile's YoutubeDL instance."""
+    return await run_task(profile, lambda: fn(_get_ydl(profile)))
+
+
+async def single_flight(key, factory):
+    """
+    Run factory() once per key at a time and share its result.
+
+    Callers arriving while a job for the same key is in flight wait on that
+    job instead of starting their own. The shared job is only cancelled when
+    every caller waiting on it has been cancelled.
+    """
+    flight = _inflight.get(key)
+    if flight is None:
+        flight = {"task": asyncio.ensure_future(factory()), "waiters": 0}
+        _inflight[key] = flight
+        flight["task"].add_done_callback(lambda _task: _inflight.pop(key, None))
+        _flight_stats["leaders"] += 1
+    else:
+        _flight_stats["joined"] += 1
+
+    flight["waiters"] += 1
+    try:
+        return await asyncio.shield(flight["task"])
+    except asyncio.CancelledError:
+        if flight["waiters"] == 1:
+            flight["task"].cancel()
+        raise
+    finally:
+        flight["waiters"] -= 1
+
+
+async def extract_info(url: str, profile: str = "metadata", download: bool = False):
+    """Awaitable wrapper around YoutubeDL.extract_info."""
+    if download:
+        return await run(profile, lambda ydl: ydl.extract_info(url, download=True))
+
+    # Lookups for the same video share one extraction, whatever the URL form
+    key = ("extract", profile, key_from_url(url) or url)
+    return await single_flight(
+        key, lambda: run(profile, lambda ydl: ydl.extract_info(url, download=False))
+    )
+
+
+async def process_ie_result(info: dict, profile: str = "download"):
+    """Download an already-extracted info dict with the given profile."""
+    # yt-dlp mutates the info dict it processes; keep the caller's copy intact
+    info = copy.deepcopy(info)
+    return await run(profile, lambda ydl: ydl.process_ie_result(info, download=True))
+
+
+class PlaylistPager:
+    """
+    Read a playlist's flat entries a page at a time in a single walk.
+
+    The first page extracts the playlist without processing it, which keeps
+    the extractor's entries as a lazy iterator; later pages carry on from
+    it. Asking yt-dlp for each page by playlist_items would re-fetch every
+    continuation before the requested items, so paging cost grew
+    quadratically with the playlist. The pager owns its YoutubeDL instance,
+    because the iterator keeps using it from whichever worker runs the next
+    page.
+    """
+
+    # Unprocessed extraction can return a "url" result pointing at the real
+    # playlist (e.g. watch?list= without a video); follow at most this many
+    MAX_URL_HOPS = 2
+
+    def __init__(self, url: str):
+        self.url = url
+        self.info = None
+        self._ydl = None
+        self._entries = None
+        # Pages and close() may run on different workers; never at once
+        self._lock = threading.Lock()
+
+    def _extract(self):
+        opts = dict(PROFILES["playlist"], progress_hooks=[_check_cancelled])
+        self._ydl = youtube_dl.YoutubeDL(opts)
+        info = self._ydl.extract_info(self.url, download=False, process=False)
+        for _hop in range(self.MAX_URL_HOPS):
+            if info.get("_type") not in ("url", "url_transparent") or not info.get("url"):
+                break
+            info = self._ydl.extract_info(
+                info["url"], download=False, process=False, ie_key=info.get("ie_key")
+            )
+        self.info = info
+        if "entries" in info:
+            self._entries = iter(info["entries"] or ())
+
+    def _next(self, count: int):
+        with self._lock:
+            if self._ydl is None:
+                self._extract()
+            if self._entries is None:
+                return None
+            return list(islice(self._entries, count))
+
+    async def next_page(self, count: int):
+        """
+        Return up to count more entries; fewer means the playlist has ended.
+
+        Returns None if the URL turned out not to be a playlist; self.info
+        then holds the single item.
+        """
+        return await run_task("playlist", lambda: self._next(count))
+
+    def _close(self):
+        with self._lock:
+            if self._ydl is not None:
+                self._ydl.close()
+                self._ydl = None
+            self._entries = None
+
+    def close(self):
+        """
+        Release the YoutubeDL instance without blocking.
+
+        Runs on the pool behind the lock, so a page still running after its
+        caller was cancelled finishes before the instance is closed.
+        """
+        _executor.submit(self._close)
+
+
+def is_permanent_error(exc: BaseException) -> bool:
+    """True if a yt-dlp error means the video itself can't be played."""
+    if not isinstance(exc, youtube_dl.utils.YoutubeDLError):
+        return False
+    message = str(exc).lower()
+    return any(pattern in message for pattern in PERMANENT_ERRORS)
+
+
+def get_metrics() -> dict:
+    """Snapshot of per-profile job counts plus queue-wait and run-time stats."""
+    with _metrics_lock:
+        snapshot = {}
+        for profile, stats in _metrics.items():
+            started = max(stats["started"], 1)
+            snapshot[profile] = dict(
+                stats,
+                wait_avg=stats["wait_total"] / started,
+                run_avg=stats["run_total"] / started,
+            )
+    return {
+        "pending": _pending,
+        "workers": YTDL_WORKERS,
+        "inflight": len(_inflight),
+        "single_flight": dict(_flight_stats),
+        "profiles": snapshot,
+    }